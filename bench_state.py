@@ -0,0 +1,56 @@
+# bench_state.py — per-user cost of the state store as the user count grows
+#
+#   python bench_state.py [ops]
+#
+# For each store size it times, per op: a baseline read (existing user/month),
+# a baseline write (new month => dirty row) and the flush of one dirty row.
+# Flat numbers across sizes mean per-user reads/writes don't depend on how many
+# users are stored. Runs against a throwaway database in a temp directory.
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import bot
+
+SIZES = (100, 1_000, 10_000, 100_000)
+
+
+def timed(fn, ops: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - t0) / ops * 1e6
+
+
+def bench(size: int, ops: int, directory: Path) -> dict:
+    store = bot.StateStore(directory / f"state_{size}.db")
+    for i in range(size):
+        store.monthly_baseline(f"u{i}", "2026-01", 1000.0)
+    store.flush()
+
+    read_us = timed(lambda i: store.monthly_baseline(f"u{i % size}", "2026-01", 0.0), ops)
+    write_us = timed(lambda i: store.monthly_baseline(f"u{i % size}", f"m{i}", 1000.0), ops)
+    store.flush()
+
+    def flush_one(i):
+        store.monthly_baseline(f"u{i % size}", f"f{i}", 1000.0)
+        store.flush()
+    flush_us = timed(flush_one, max(1, ops // 10))
+    return {"read_us": read_us, "write_us": write_us, "flush_one_us": flush_us}
+
+
+def main():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    print(f"{'users':>8} {'read us/op':>11} {'write us/op':>12} {'flush 1 row us':>15}")
+    with tempfile.TemporaryDirectory() as tmp:
+        # keep the store's legacy-file import away from the real state files
+        bot.MONTHLY_FILE = bot.BTC_LAST_FILE = Path(tmp) / "absent"
+        for size in SIZES:
+            r = bench(size, ops, Path(tmp))
+            print(f"{size:>8} {r['read_us']:>11.2f} {r['write_us']:>12.2f} {r['flush_one_us']:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
 # Commands:
 #   /wallet   -> menu (Free Balance / In-Trade / Open Positions)
 #   /pnl      -> Month-to-date PnL (includes open trades) + shows your open assets + current price
+#   /pnl 7d | ytd | YYYY-MM -> PnL over a range, from the recorded daily equity
 #   /ids      -> shows user_id + chat_id (auto-delete 5s)
 #   /commands -> list commands (auto-delete 8s)
 #
@@ -12,17 +13,40 @@
 #   /comandos -> /commands
 
 import os
+import asyncio
 import time
 import hmac
 import hashlib
 import logging
 import json
+import heapq
+import bisect
+import struct
+import random
 import threading
-from datetime import datetime
-from urllib.parse import urlencode
+import sqlite3
+import atexit
+import signal
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlsplit
 from pathlib import Path
 
 import requests
+try:
+    import aiohttp  # optional: only needed for BOT_ENGINE=async
+    import aiohttp.web
+except ImportError:
+    aiohttp = None
+try:
+    import websocket  # optional: websocket-client, only needed for BYBIT_WS_ENABLED
+except ImportError:
+    websocket = None
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
 
 # --- Load .env ---
 try:
@@ -43,25 +67,121 @@ BYBIT_TESTNET = os.getenv("BYBIT_TESTNET", "false").lower() == "true"
 BYBIT_BASE_URL = "https://api-testnet.bybit.com" if BYBIT_TESTNET else "https://api.bybit.com"
 
 BTC_ALERT_SECONDS = int(os.getenv("BTC_ALERT_SECONDS", "2700"))  # 45 min
+BTC_ALERT_JITTER_SECONDS = float(os.getenv("BTC_ALERT_JITTER_SECONDS", "0"))
 AUTO_DELETE_SECONDS = int(os.getenv("AUTO_DELETE_SECONDS", "5"))
 
+# HTTP transport (keep-alive pools, one per host)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+TELEGRAM_HTTP_TIMEOUT = float(os.getenv("TELEGRAM_HTTP_TIMEOUT", "20"))
+BYBIT_HTTP_TIMEOUT = float(os.getenv("BYBIT_HTTP_TIMEOUT", "20"))
+STATS_LOG_SECONDS = int(os.getenv("STATS_LOG_SECONDS", "3600"))
+
+# Bybit fan-out (position legs queried in parallel under one deadline)
+BYBIT_FANOUT_WORKERS = int(os.getenv("BYBIT_FANOUT_WORKERS", "16"))
+POSITIONS_DEADLINE_SECONDS = float(os.getenv("POSITIONS_DEADLINE_SECONDS", "8"))
+
+# Market data: one bulk tickers call per category, refreshed in the background
+TICKER_REFRESH_SECONDS = float(os.getenv("TICKER_REFRESH_SECONDS", "15"))
+TICKER_MAX_AGE_SECONDS = float(os.getenv("TICKER_MAX_AGE_SECONDS", "30"))  # older => refresh on read
+
+# Bybit public WebSocket price feed (falls back to the REST ticker cache)
+BYBIT_WS_ENABLED = os.getenv("BYBIT_WS_ENABLED", "false").lower() == "true"
+BYBIT_WS_PUBLIC_URL = os.getenv(
+    "BYBIT_WS_PUBLIC_URL",
+    "wss://stream-testnet.bybit.com/v5/public" if BYBIT_TESTNET else "wss://stream.bybit.com/v5/public",
+)
+WS_PING_SECONDS = float(os.getenv("WS_PING_SECONDS", "20"))
+WS_STALE_SECONDS = float(os.getenv("WS_STALE_SECONDS", "30"))  # older live prices => REST
+WS_RECONNECT_MAX_SECONDS = float(os.getenv("WS_RECONNECT_MAX_SECONDS", "60"))
+
+# Bybit private WebSocket (position + wallet) per user, so /wallet renders from memory
+BYBIT_WS_PRIVATE_ENABLED = os.getenv("BYBIT_WS_PRIVATE_ENABLED", "false").lower() == "true"
+BYBIT_WS_PRIVATE_URL = os.getenv(
+    "BYBIT_WS_PRIVATE_URL",
+    "wss://stream-testnet.bybit.com/v5/private" if BYBIT_TESTNET else "wss://stream.bybit.com/v5/private",
+)
+ACCOUNT_RESEED_SECONDS = float(os.getenv("ACCOUNT_RESEED_SECONDS", "120"))  # REST resync of the local model
+
+# Resilience: idempotent calls retry with capped, jittered exponential backoff;
+# each endpoint has a circuit breaker that fails fast once it keeps failing
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_SECONDS = float(os.getenv("RETRY_BASE_SECONDS", "0.3"))
+RETRY_MAX_SECONDS = float(os.getenv("RETRY_MAX_SECONDS", "3"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # consecutive failures that open a circuit
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+
+# Bybit rate governor: per-IP window plus the per-key quota Bybit reports in headers
+BYBIT_IP_LIMIT = int(os.getenv("BYBIT_IP_LIMIT", "600"))
+BYBIT_IP_WINDOW_SECONDS = float(os.getenv("BYBIT_IP_WINDOW_SECONDS", "5"))
+BYBIT_QUOTA_RESERVE = int(os.getenv("BYBIT_QUOTA_RESERVE", "1"))  # calls kept in hand per key/endpoint
+
+# Account snapshot cache (per user): fresh for TTL, then served stale while
+# a background refresh runs, for up to SNAPSHOT_STALE_SECONDS more
+SNAPSHOT_TTL_SECONDS = float(os.getenv("SNAPSHOT_TTL_SECONDS", "5"))
+SNAPSHOT_STALE_SECONDS = float(os.getenv("SNAPSHOT_STALE_SECONDS", "30"))
+SNAPSHOT_CACHE_SIZE = int(os.getenv("SNAPSHOT_CACHE_SIZE", "64"))
+
+# Webhook mode (set WEBHOOK_URL): Telegram POSTs updates to an embedded HTTP server
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public https URL Telegram should call
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # checked against X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or (urlsplit(WEBHOOK_URL).path if WEBHOOK_URL else "") or "/"
+# Singleton jobs (BTC alert, equity sampler, closed-PnL sync). With several
+# webhook replicas, leave this on for exactly one of them; see README.
+RUN_JOBS = os.getenv("RUN_JOBS", "true").lower() == "true"
+
+# Engine: "sync" (threads + requests) or "async" (asyncio + aiohttp)
+BOT_ENGINE = os.getenv("BOT_ENGINE", "sync").lower()
+
+# Outbound Telegram rate limits (token buckets; Telegram allows ~30 msg/s overall,
+# ~1 msg/s per chat and 20 msg/min per group)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_PER_MINUTE = float(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "4"))
+
+# Update dispatch (handlers for different users run concurrently)
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+
 # Auto-delete timers
 COMMANDS_DELETE_SECONDS = 8
 PNL_DELETE_SECONDS = 7
 IDS_DELETE_SECONDS = 5  # ✅ requested
 
-# Monthly snapshot file (MTD baseline)
-MONTHLY_FILE = Path(__file__).resolve().parent / "monthly_snapshot.json"
+# Bot state (MTD baselines, BTC anti-spam, learned account types), SQLite in WAL mode
+STATE_DB_FILE = Path(__file__).resolve().parent / "bot_state.db"
+STATE_FLUSH_SECONDS = float(os.getenv("STATE_FLUSH_SECONDS", "2"))  # write-behind interval
 
-# BTC anti-spam persistence
+# Legacy state files, imported into STATE_DB_FILE once and renamed to *.migrated
+MONTHLY_FILE = Path(__file__).resolve().parent / "monthly_snapshot.json"
 BTC_LAST_FILE = Path(__file__).resolve().parent / "btc_last_sent.txt"
 
+# Equity history: per-user samples of equity/wallet/open PnL in fixed-width binary files
+EQUITY_DIR = Path(__file__).resolve().parent / "equity"
+EQUITY_SAMPLE_SECONDS = float(os.getenv("EQUITY_SAMPLE_SECONDS", "60"))  # 0 disables the sampler
+
+# Closed-PnL ledger: realized trades synced incrementally from Bybit into STATE_DB_FILE
+LEDGER_SYNC_SECONDS = float(os.getenv("LEDGER_SYNC_SECONDS", "600"))  # 0 disables the sync job
+LEDGER_BACKFILL_DAYS = int(os.getenv("LEDGER_BACKFILL_DAYS", "365"))  # first sync reaches this far back (Bybit keeps 2y)
+LEDGER_WORKERS = int(os.getenv("LEDGER_WORKERS", "4"))  # 7-day windows fetched in parallel
+
+# Pending auto-deletes survive restarts here
+CLEANUP_FILE = Path(__file__).resolve().parent / "pending_deletions.json"
+CLEANUP_MAX_PENDING = int(os.getenv("CLEANUP_MAX_PENDING", "5000"))
+CLEANUP_COALESCE_SECONDS = float(os.getenv("CLEANUP_COALESCE_SECONDS", "0.5"))  # batch deletes due this close together
+
+# Learned Bybit accountType per user (skips failed wallet probes), kept in STATE_DB_FILE
+ACCOUNT_TYPE_REPROBE_SECONDS = int(os.getenv("ACCOUNT_TYPE_REPROBE_SECONDS", "21600"))  # 6h
+
 
 # -------------------- STATE --------------------
 telegram_update_offset = None
 btc_last_sent_ts = 0
 
-# For /wallet inline menu cleanup
+# For /wallet inline menu cleanup (per process: a button tap served by another
+# webhook replica can't clean up the menu)
 # { user_id: {"cmd_msg_id": int, "menu_msg_id": int, "chat_id": str} }
 wallet_context: dict[int, dict] = {}
 
@@ -70,6 +190,12 @@ wallet_context: dict[int, dict] = {}
 def require_env():
     if not TELEGRAM_BOT_TOKEN:
         raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_URL requires WEBHOOK_SECRET")
+
+def exit_on_sigterm(signum, frame):
+    # Unwind normally on `docker stop` / systemd so atexit hooks (state flush) run
+    raise SystemExit(0)
 
 def fmt_usd(x) -> str:
     try:
@@ -78,43 +204,605 @@ def fmt_usd(x) -> str:
         return "$-"
 
 def schedule_cleanup(chat_id: str, msg_ids: list[int], delay_seconds: int):
-    def _do():
-        for mid in msg_ids:
-            telegram_delete_message(chat_id, mid)
-    t = threading.Timer(delay_seconds, _do)
-    t.daemon = True
-    t.start()
+    cleanup_queue.add(chat_id, msg_ids, delay_seconds)
 
 def load_btc_last_sent():
     global btc_last_sent_ts
     try:
-        if BTC_LAST_FILE.exists():
-            btc_last_sent_ts = int(BTC_LAST_FILE.read_text().strip())
+        btc_last_sent_ts = int(state_store.get_kv("btc_last_sent") or 0)
     except Exception:
         btc_last_sent_ts = 0
 
 def save_btc_last_sent(ts: int):
     try:
-        BTC_LAST_FILE.write_text(str(ts))
+        state_store.set_kv("btc_last_sent", str(ts))
+    except Exception as e:
+        logger.warning(f"save btc_last_sent failed: {e}")
+
+def load_account_types() -> dict:
+    try:
+        return state_store.account_types()
     except Exception:
-        pass
+        return {}
+
+def save_account_type(key_id: str, acct: str):
+    try:
+        state_store.set_account_type(key_id, acct)
+    except Exception as e:
+        logger.warning(f"save account type failed: {e}")
+
+
+# -------------------- STATS --------------------
+# Lightweight in-process counters: stats_inc for counts, stats_observe for
+# durations/sizes (count/sum/max), stats_gauge for last-value readings.
+_stats_lock = threading.Lock()
+_stats: dict[str, float] = {}
+_stats_obs: dict[str, dict] = {}
+
+def stats_inc(name: str, n: float = 1):
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + n
+
+def stats_gauge(name: str, value: float):
+    with _stats_lock:
+        _stats[name] = value
+
+def stats_observe(name: str, value: float):
+    with _stats_lock:
+        o = _stats_obs.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        o["count"] += 1
+        o["sum"] += value
+        o["max"] = max(o["max"], value)
+
+def stats_snapshot() -> dict:
+    with _stats_lock:
+        out = dict(_stats)
+        for name, o in _stats_obs.items():
+            out[f"{name}.count"] = o["count"]
+            out[f"{name}.avg"] = o["sum"] / o["count"] if o["count"] else 0.0
+            out[f"{name}.max"] = o["max"]
+        return out
+
+
+# -------------------- HTTP TRANSPORT --------------------
+# One requests.Session per host so Telegram and Bybit calls reuse keep-alive
+# TLS connections instead of paying a new handshake on every request.
+HOST_TIMEOUTS = {
+    "api.telegram.org": TELEGRAM_HTTP_TIMEOUT,
+    "api.bybit.com": BYBIT_HTTP_TIMEOUT,
+    "api-testnet.bybit.com": BYBIT_HTTP_TIMEOUT,
+}
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        t0 = time.perf_counter()
+        super().connect()
+        stats_inc(f"http.{self.host}.connects")
+        stats_observe(f"http.{self.host}.handshake_s", time.perf_counter() - t0)
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            **self.poolmanager.pool_classes_by_scheme,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+def http_session(host: str) -> requests.Session:
+    with _sessions_lock:
+        s = _sessions.get(host)
+        if s is None:
+            s = requests.Session()
+            adapter = _PooledAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _sessions[host] = s
+        return s
+
+def http_request(method: str, url: str, timeout=None, **kwargs) -> requests.Response:
+    host = urlsplit(url).hostname or ""
+    if timeout is None:
+        timeout = HOST_TIMEOUTS.get(host, 20)
+    stats_inc(f"http.{host}.requests")
+    return http_session(host).request(method, url, timeout=timeout, **kwargs)
+
+def http_reuse_stats() -> dict:
+    """
+    Per-host connection reuse: requests vs new TLS connections and the
+    average handshake time each reused request avoided.
+    """
+    snap = stats_snapshot()
+    out = {}
+    for host in list(_sessions):
+        reqs = snap.get(f"http.{host}.requests", 0)
+        conns = snap.get(f"http.{host}.connects", 0)
+        out[host] = {
+            "requests": int(reqs),
+            "connects": int(conns),
+            "reused": int(max(0, reqs - conns)),
+            "handshake_avg_ms": round(snap.get(f"http.{host}.handshake_s.avg", 0.0) * 1000, 1),
+            "saved_ms": round(max(0, reqs - conns) * snap.get(f"http.{host}.handshake_s.avg", 0.0) * 1000, 1),
+        }
+    return out
+
+def log_stats():
+    logger.info(f"HTTP reuse: {http_reuse_stats()}")
+    logger.info(f"Stats: {stats_snapshot()}")
+
+
+# -------------------- RESILIENCE --------------------
+# Calls go through resilient_call with an endpoint name. Failures worth
+# retrying (transport errors, 5xx, undecodable bodies, Bybit server-side
+# retCodes) are retried for idempotent calls only, sleeping a random
+# 0..min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2^attempt) between tries.
+# After BREAKER_FAILURES consecutive failures an endpoint's circuit opens and
+# callers get the fallback at once for BREAKER_COOLDOWN_SECONDS; then a single
+# trial call is let through, which closes the circuit or opens it again.
+BYBIT_RETRY_CODES = {10000, 10016}  # server timeout, server error / restarting
+
+class TransientError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failures: int, cooldown: float):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.streak = 0
+        self.opened_at = None
+        self.trial = False  # half-open probe in flight
+
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            was_open = self.opened_at is not None
+            self.streak = 0
+            self.opened_at = None
+            self.trial = False
+        if was_open:
+            logger.info(f"Circuit closed: {self.name}")
+            stats_gauge("resilience.open_circuits", open_circuits())
+
+    def failure(self):
+        with self.lock:
+            self.streak += 1
+            opening = self.opened_at is None and self.streak >= self.failures
+            if opening or self.trial:
+                self.opened_at = time.monotonic()
+            self.trial = False
+        if opening:
+            logger.warning(f"Circuit open: {self.name} ({self.streak} consecutive failures)")
+            stats_inc("resilience.circuit_opens")
+            stats_gauge("resilience.open_circuits", open_circuits())
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def breaker_for(endpoint: str) -> CircuitBreaker:
+    with _breakers_lock:
+        b = _breakers.get(endpoint)
+        if b is None:
+            b = _breakers[endpoint] = CircuitBreaker(endpoint, BREAKER_FAILURES, BREAKER_COOLDOWN_SECONDS)
+        return b
+
+def open_circuits() -> int:
+    return sum(1 for b in list(_breakers.values()) if b.is_open())
+
+def backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+def response_json(r: requests.Response) -> dict:
+    if r.status_code >= 500:
+        raise TransientError(f"HTTP {r.status_code}")
+    return r.json()
+
+def bybit_checked(data: dict) -> dict:
+    if isinstance(data, dict) and data.get("retCode") in BYBIT_RETRY_CODES:
+        raise TransientError(f"retCode {data.get('retCode')}: {data.get('retMsg')}")
+    return data
 
+def bybit_fallback(reason: str) -> dict:
+    return {"retCode": -1, "retMsg": reason}
 
-# -------------------- MONTHLY SNAPSHOT --------------------
-def load_monthly_data() -> dict:
-    if MONTHLY_FILE.exists():
+def telegram_fallback(reason: str) -> dict:
+    return {"ok": False, "description": reason}
+
+TRANSIENT_ERRORS = (TransientError, requests.RequestException, ValueError)
+
+def _attempt_failed(endpoint: str, breaker: CircuitBreaker, attempt: int, attempts: int, e: Exception) -> bool:
+    """Record a failed attempt; True if the caller should back off and retry."""
+    breaker.failure()
+    if attempt + 1 >= attempts:
+        stats_inc("resilience.gave_up")
+        logger.warning(f"{endpoint} failed after {attempts} attempt(s): {type(e).__name__}: {e}")
+        return False
+    stats_inc("resilience.retries")
+    stats_inc(f"resilience.{endpoint}.retries")
+    return True
+
+def deadline_timeout(deadline: float | None, default: float) -> float:
+    """HTTP timeout for one attempt: the default, capped at what's left before `deadline` (monotonic)."""
+    if deadline is None:
+        return default
+    return max(0.1, min(default, deadline - time.monotonic()))
+
+def resilient_call(endpoint: str, fn, fallback, idempotent=True, deadline: float | None = None):
+    """
+    Run fn() behind the endpoint's circuit breaker, retrying transient failures
+    when the call is idempotent. Returns fn's result, or fallback(reason) when
+    the circuit is open, every attempt failed, or no retry fits before
+    `deadline` (time.monotonic()).
+    """
+    breaker = breaker_for(endpoint)
+    attempts = max(1, RETRY_ATTEMPTS) if idempotent else 1
+    for attempt in range(attempts):
+        if not breaker.allow():
+            stats_inc("resilience.fast_fails")
+            return fallback(f"circuit open: {endpoint}")
         try:
-            return json.loads(MONTHLY_FILE.read_text(encoding="utf-8"))
+            result = fn()
+        except TRANSIENT_ERRORS as e:
+            reason = f"{type(e).__name__}: {e}"
+            if not _attempt_failed(endpoint, breaker, attempt, attempts, e):
+                return fallback(reason)
+            delay = backoff_delay(attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                stats_inc("resilience.deadline_give_ups")
+                return fallback(reason)
+            time.sleep(delay)
+            continue
         except Exception:
-            return {}
-    return {}
+            breaker.failure()
+            raise
+        breaker.success()
+        return result
+
+
+# -------------------- SINGLE-FLIGHT --------------------
+# Identical requests already in flight (same endpoint, params and API key) are
+# not sent again: later callers wait for the first call and share its result.
+# Nothing is cached once the call returns. Shared results must be treated as
+# read-only by callers.
+def flight_key(endpoint: str, params: dict | None, key_id: str | None = None) -> tuple:
+    return endpoint, key_id, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items()))
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict[tuple, Future] = {}
+        self.acalls: dict[tuple, asyncio.Future] = {}  # event-loop thread only
+
+    def do(self, key: tuple, fn):
+        with self.lock:
+            fut = self.calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self.calls[key] = Future()
+        if not leader:
+            stats_inc("singleflight.shared")
+            return fut.result()
+        stats_inc("singleflight.calls")
+        try:
+            result = fn()
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+    async def ado(self, key: tuple, coro_fn):
+        """
+        The shared call runs as its own task and every caller (the first one
+        included) awaits it through shield, so a caller that is cancelled,
+        e.g. a position leg past its deadline, doesn't cancel it for the rest.
+        """
+        task = self.acalls.get(key)
+        if task is None:
+            stats_inc("singleflight.calls")
+            task = self.acalls[key] = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda t: self._adone(key, t))
+        else:
+            stats_inc("singleflight.shared")
+        return await asyncio.shield(task)
+
+    def _adone(self, key: tuple, task: asyncio.Task):
+        if self.acalls.get(key) is task:
+            del self.acalls[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved when every caller was cancelled
+
+singleflight = SingleFlight()
+
+# -------------------- SCHEDULER --------------------
+class Job:
+    def __init__(self, name: str, interval: float, fn, jitter: float, missed: str):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.jitter = jitter
+        self.missed = missed
+        self.planned = 0.0  # un-jittered slot, so jitter never accumulates into drift
+        self.due = 0.0
+
+
+class Scheduler:
+    """
+    Periodic jobs kept in a min-heap by due time. One thread waits for the next
+    due job and runs it on a small worker pool, so a slow job neither delays
+    the others nor overlaps itself (it is re-armed only after it finishes).
 
-def save_monthly_data(data: dict):
-    try:
-        MONTHLY_FILE.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
-    except Exception:
-        pass
+    Missed-run policy, when a run ends after one or more later slots passed:
+      "skip"     - drop the missed slots; next run at the next future slot
+      "catch_up" - run the missed slots back to back
+    """
+
+    def __init__(self, workers: int = 4):
+        self.heap: list[tuple[float, int, Job]] = []
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.thread = None
+
+    def add(self, name: str, interval: float, fn, jitter: float = 0.0, missed: str = "skip",
+            first_delay: float | None = None):
+        job = Job(name, interval, fn, jitter, missed)
+        job.planned = time.monotonic() + (interval if first_delay is None else first_delay)
+        self._arm(job)
+        return job
+
+    def _arm(self, job: Job):
+        job.due = job.planned + (random.uniform(0, job.jitter) if job.jitter else 0.0)
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.heap, (job.due, self.seq, job))
+            self.cond.notify()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(timeout=self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, job = heapq.heappop(self.heap)
+            try:
+                self.pool.submit(self._run, job)
+            except RuntimeError:
+                return  # interpreter shutting down
 
+    def _run(self, job: Job):
+        started = time.monotonic()
+        stats_observe(f"job.{job.name}.lag_s", max(0.0, started - job.due))
+        try:
+            job.fn()
+            stats_inc(f"job.{job.name}.runs")
+        except Exception as e:
+            stats_inc(f"job.{job.name}.failures")
+            logger.error(f"Job {job.name} failed: {e}")
+        finished = time.monotonic()
+        stats_observe(f"job.{job.name}.duration_s", finished - started)
+
+        job.planned += job.interval
+        if job.planned < finished:
+            if job.missed == "skip":
+                behind = int((finished - job.planned) // job.interval) + 1
+                stats_inc(f"job.{job.name}.skipped", behind)
+                job.planned += behind * job.interval
+            else:
+                stats_inc(f"job.{job.name}.catch_up")
+        self._arm(job)
+
+scheduler = Scheduler()
+
+
+# -------------------- STATE STORE --------------------
+class StateStore:
+    """
+    Small bot state: one row per (user, month) for the MTD baseline (past
+    months are kept), one per API key for the learned account type, plus a
+    key/value table.
+
+    Memory is authoritative. Everything is loaded once on first use; reads and
+    writes only touch in-memory dicts and mark the row dirty, so handlers never
+    wait on disk. flush() (every STATE_FLUSH_SECONDS on the scheduler, and at
+    exit) writes the dirty rows in one SQLite (WAL) transaction. A write that
+    fails stays dirty for the next flush. Connections are per thread.
+
+    On first use the legacy JSON/txt files are imported in one transaction
+    and then renamed to *.migrated; rows already present are never replaced,
+    so an interrupted migration simply re-runs.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS monthly_baselines (
+            user_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            start_wallet REAL NOT NULL,
+            PRIMARY KEY (user_id, month)
+        );
+        CREATE TABLE IF NOT EXISTS account_types (
+            key_id TEXT PRIMARY KEY,
+            acct TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS kv (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+    UPSERTS = {
+        "monthly": "INSERT INTO monthly_baselines (user_id, month, start_wallet) VALUES (?, ?, ?) "
+                   "ON CONFLICT(user_id, month) DO UPDATE SET start_wallet = excluded.start_wallet",
+        "account_types": "INSERT INTO account_types (key_id, acct) VALUES (?, ?) "
+                         "ON CONFLICT(key_id) DO UPDATE SET acct = excluded.acct",
+        "kv": "INSERT INTO kv (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+    }
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.loaded = False
+        self.tables: dict[str, dict] = {"monthly": {}, "account_types": {}, "kv": {}}
+        self.dirty: set[tuple[str, str]] = set()
+
+    def conn(self) -> sqlite3.Connection:
+        c = getattr(self.local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = c
+        return c
+
+    def table(self, name: str) -> dict:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return self.tables[name]
+
+    def load(self):
+        c = self.conn()
+        c.executescript(self.SCHEMA)
+        self.migrate_legacy(c)
+        for user_key, month, start in c.execute("SELECT user_id, month, start_wallet FROM monthly_baselines"):
+            self.tables["monthly"][(user_key, month)] = float(start)
+        self.tables["account_types"].update(c.execute("SELECT key_id, acct FROM account_types"))
+        self.tables["kv"].update(c.execute("SELECT name, value FROM kv"))
+        self.loaded = True
+
+    def migrate_legacy(self, c: sqlite3.Connection):
+        monthly = self._read_json(MONTHLY_FILE)
+        btc_last = None
+        if BTC_LAST_FILE.exists():
+            try:
+                btc_last = str(int(BTC_LAST_FILE.read_text().strip()))
+            except Exception:
+                btc_last = None
+        if monthly is None and btc_last is None:
+            return
+
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            for user_key, row in (monthly or {}).items():
+                start = row.get("start_wallet", row.get("start_equity"))  # pre-start_wallet files
+                if row.get("month") and start is not None:
+                    c.execute(
+                        "INSERT OR IGNORE INTO monthly_baselines (user_id, month, start_wallet) VALUES (?, ?, ?)",
+                        (str(user_key), row["month"], float(start)),
+                    )
+            if btc_last is not None:
+                c.execute("INSERT OR IGNORE INTO kv (name, value) VALUES ('btc_last_sent', ?)", (btc_last,))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+        for f in (MONTHLY_FILE, BTC_LAST_FILE):
+            if f.exists():
+                f.replace(f.with_name(f.name + ".migrated"))
+        logger.info(f"Migrated legacy state files into {self.path.name}")
+
+    @staticmethod
+    def _read_json(path: Path) -> dict | None:
+        if not path.exists():
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            logger.warning(f"Ignoring unreadable {path.name}")
+            return None
+
+    def _set(self, table: str, key: str | tuple, value):
+        with self.lock:
+            self.table(table)[key] = value
+            self.dirty.add((table, key))
+
+    def flush(self):
+        """Write dirty rows in one transaction; rows that fail stay dirty."""
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                batch = [(t, k, self.tables[t][k]) for t, k in self.dirty]
+                self.dirty.clear()
+            t0 = time.perf_counter()
+            c = self.conn()
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                for table, key, value in batch:
+                    row = (*key, value) if table == "monthly" else (key, value)
+                    c.execute(self.UPSERTS[table], row)
+                c.execute("COMMIT")
+            except Exception as e:
+                if c.in_transaction:
+                    c.execute("ROLLBACK")
+                with self.lock:
+                    self.dirty.update((t, k) for t, k, _ in batch)
+                logger.warning(f"State flush failed ({len(batch)} rows): {e}")
+                stats_inc("state.flush_failures")
+                return
+            stats_inc("state.flushes")
+            stats_inc("state.rows_flushed", len(batch))
+            stats_observe("state.flush_s", time.perf_counter() - t0)
+
+    def monthly_baseline(self, user_key: str, month: str, wallet: float) -> float:
+        """
+        The user's baseline wallet for `month`, snapshotting `wallet` as the
+        baseline the first time that month is seen.
+        """
+        with self.lock:
+            start = self.table("monthly").get((user_key, month))
+            if start is None:
+                start = float(wallet)
+                self._set("monthly", (user_key, month), start)
+            return start
+
+    def account_types(self) -> dict:
+        with self.lock:
+            return dict(self.table("account_types"))
+
+    def set_account_type(self, key_id: str, acct: str):
+        self._set("account_types", key_id, acct)
+
+    def get_kv(self, name: str) -> str | None:
+        with self.lock:
+            return self.table("kv").get(name)
+
+    def set_kv(self, name: str, value: str):
+        self._set("kv", name, value)
+
+state_store = StateStore(STATE_DB_FILE)
+atexit.register(state_store.flush)
+
+
+# -------------------- MONTH KEYS --------------------
 def current_month_key() -> str:
     return datetime.now().strftime("%Y-%m")
 
@@ -126,35 +814,81 @@ def month_label(month_key: str) -> str:
 
 
 # -------------------- TELEGRAM (RAW API) --------------------
-def tg_get(method: str, params: dict | None = None, timeout=20):
+# Safe to repeat if a response is lost (a retried sendMessage could post twice)
+TG_IDEMPOTENT_METHODS = {"deleteMessage", "deleteMessages", "setWebhook", "deleteWebhook"}
+
+def tg_get(method: str, params: dict | None = None, timeout=None):
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
-    r = requests.get(url, params=params, timeout=timeout)
-    return r.json()
+    return resilient_call(
+        f"telegram.{method}",
+        lambda: response_json(http_request("GET", url, params=params, timeout=timeout)),
+        telegram_fallback,
+    )
 
-def tg_post(method: str, payload: dict, timeout=20):
+def tg_post(method: str, payload: dict, timeout=None):
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
-    r = requests.post(url, json=payload, timeout=timeout)
-    return r.json()
+    return resilient_call(
+        f"telegram.{method}",
+        lambda: response_json(http_request("POST", url, json=payload, timeout=timeout)),
+        telegram_fallback,
+        idempotent=method in TG_IDEMPOTENT_METHODS,
+    )
+
+# Outbox priorities (lower goes first)
+PRIORITY_REPLY = 0
+PRIORITY_ALERT = 1
+PRIORITY_CLEANUP = 2
+
+def telegram_send(chat_id: str, text: str, reply_markup: dict | None = None, priority: int = PRIORITY_REPLY):
+    payload = send_payload(chat_id, text, reply_markup)
+    return send_result(outbox.call("sendMessage", payload, priority))
 
-def telegram_send(chat_id: str, text: str, reply_markup: dict | None = None):
+def send_payload(chat_id: str, text: str, reply_markup: dict | None = None) -> dict:
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML"}
     if reply_markup:
         payload["reply_markup"] = reply_markup
-    data = tg_post("sendMessage", payload)
+    return payload
+
+def send_result(data: dict):
     if not data.get("ok"):
         logger.error(f"sendMessage failed: {data}")
         return False, data.get("description", str(data)), None
     return True, "", (data.get("result") or {}).get("message_id")
 
-def telegram_delete_message(chat_id: str, message_id: int):
-    data = tg_post("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
+def delete_result(data: dict, chat_id: str, message_id: int) -> bool:
     if not data.get("ok"):
         # deleting can fail if too old / missing admin perms, etc.
         logger.warning(f"deleteMessage failed chat={chat_id} msg={message_id}: {data}")
         return False
     return True
 
+def telegram_delete_message(chat_id: str, message_id: int):
+    data = outbox.call("deleteMessage", {"chat_id": chat_id, "message_id": message_id}, PRIORITY_CLEANUP)
+    return delete_result(data, chat_id, message_id)
+
+DELETE_BATCH_MAX = 100  # deleteMessages limit
+
+def delete_batches(message_ids: list[int]) -> list[list[int]]:
+    ids = sorted(set(message_ids))
+    return [ids[i:i + DELETE_BATCH_MAX] for i in range(0, len(ids), DELETE_BATCH_MAX)]
+
+def telegram_delete_messages(chat_id: str, message_ids: list[int]):
+    """
+    Delete many messages with deleteMessages (100 ids per call). A lone id, or a
+    batch Telegram rejects, falls back to one deleteMessage per id.
+    """
+    for batch in delete_batches(message_ids):
+        if len(batch) > 1:
+            data = outbox.call("deleteMessages", {"chat_id": chat_id, "message_ids": batch}, PRIORITY_CLEANUP)
+            if data.get("ok"):
+                stats_inc("cleanup.batched", len(batch))
+                continue
+            logger.warning(f"deleteMessages failed chat={chat_id} ids={batch}: {data}; deleting one by one")
+        for mid in batch:
+            telegram_delete_message(chat_id, mid)
+
 def telegram_answer_callback(callback_query_id: str, text: str = "", show_alert: bool = False):
+    # Not a chat message, so it skips the outbox (the user is watching a spinner)
     tg_post("answerCallbackQuery", {
         "callback_query_id": callback_query_id,
         "text": text,
@@ -165,32 +899,330 @@ def telegram_delete_webhook_drop_pending():
     # Avoid "webhook vs polling" conflicts
     logger.info(f"deleteWebhook: {tg_get('deleteWebhook', {'drop_pending_updates': 'true'})}")
 
-def telegram_get_updates(timeout=30):
-    global telegram_update_offset
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/getUpdates"
+def set_webhook_payload() -> dict:
+    return {
+        "url": WEBHOOK_URL,
+        "secret_token": WEBHOOK_SECRET,
+        "allowed_updates": ["message", "callback_query"],
+    }
+
+def telegram_set_webhook():
+    # Idempotent, so every replica can call it on startup
+    logger.info(f"setWebhook: {tg_post('setWebhook', set_webhook_payload())}")
+
+def get_updates_params(timeout: int) -> dict:
     params = {
         "timeout": timeout,
         "allowed_updates": json.dumps(["message", "callback_query"]),
     }
     if telegram_update_offset is not None:
         params["offset"] = telegram_update_offset
+    return params
 
-    r = requests.get(url, params=params, timeout=timeout + 20)
-    data = r.json()
-
+def accept_updates(data: dict) -> list | None:
+    """
+    Advance the polling offset from a getUpdates response.
+    Returns the updates, or None on failure (caller should back off).
+    """
+    global telegram_update_offset
     if not data.get("ok"):
         if data.get("error_code") == 409:
             logger.error("409 CONFLICT: another instance is polling getUpdates.")
-            time.sleep(5)
-            return []
-        logger.error(f"getUpdates failed: {data}")
-        return []
+        else:
+            logger.error(f"getUpdates failed: {data}")
+        return None
 
     updates = data.get("result", [])
     if updates:
         telegram_update_offset = updates[-1]["update_id"] + 1
     return updates
 
+def telegram_get_updates(timeout=30):
+    updates = accept_updates(tg_get("getUpdates", get_updates_params(timeout), timeout=timeout + TELEGRAM_HTTP_TIMEOUT))
+    if updates is None:
+        time.sleep(5)
+        return []
+    return updates
+
+
+# -------------------- OUTBOUND QUEUE (RATE LIMITS) --------------------
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # set from a 429 retry_after
+
+    def _fill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._fill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0, 0.0)
+
+    def take(self, now: float):
+        self._fill(now)
+        self.tokens -= 1
+
+
+class TelegramOutbox:
+    """
+    Every sendMessage / deleteMessage(s) goes through here: a priority queue
+    (replies, then alerts, then cleanup) drained by one thread that spends
+    tokens from a global bucket before handing the call to a worker.
+    sendMessage also spends from a per-chat bucket (Telegram's per-chat and
+    per-group message limits); deletions don't, so cleanup never eats into a
+    group's 20/min reply budget. A 429 blocks that chat for retry_after and
+    re-queues the call.
+    Callers block on the result, so they still get the API response back.
+
+    With BOT_ENGINE=async, start_async() drains the same queue from a task on
+    the event loop instead, posting each call as its own coroutine so the
+    number of in-flight sends isn't capped by worker threads.
+    """
+
+    def __init__(self, workers: int):
+        self.heap: list[tuple] = []  # (priority, seq, enqueued_at, method, payload, future, attempts)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.chat_buckets: dict[str, TokenBucket] = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tg-send")
+        self.poster = tg_post
+        self.thread = None
+        self.loop = None  # set by start_async
+        self.apost = None
+        self.wakeup = None
+
+    def start(self, poster=None):
+        if poster:
+            self.poster = poster
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="tg-outbox", daemon=True)
+            self.thread.start()
+
+    def start_async(self, loop: asyncio.AbstractEventLoop, poster):
+        """Drain on `loop`; poster(method, payload) is a coroutine function."""
+        self.loop = loop
+        self.apost = poster
+        self.wakeup = asyncio.Event()
+        _spawn(self._aloop())
+
+    def chat_bucket(self, chat_id: str) -> TokenBucket:
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            group = chat_id.startswith("-")
+            rate = TG_GROUP_PER_MINUTE / 60 if group else TG_CHAT_RATE
+            b = self.chat_buckets[chat_id] = TokenBucket(rate, TG_CHAT_BURST)
+        return b
+
+    def chat_wait(self, item, now: float) -> float:
+        bucket = self.chat_bucket(str(item[4].get("chat_id")))
+        if item[3] == "sendMessage":
+            return bucket.wait_time(now)
+        return max(bucket.blocked_until - now, 0.0)  # only honour a 429 block
+
+    def submit(self, method: str, payload: dict, priority: int = PRIORITY_REPLY, attempts: int = 0,
+               future: Future | None = None, enqueued_at: float | None = None) -> Future:
+        if self.thread is None and self.loop is None:
+            self.start()
+        future = future or Future()
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.heap, (priority, self.seq, enqueued_at or time.monotonic(),
+                                       method, payload, future, attempts))
+            stats_gauge("tg.queue_len", len(self.heap))
+            self.cond.notify()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return future
+
+    def call(self, method: str, payload: dict, priority: int = PRIORITY_REPLY) -> dict:
+        return self.submit(method, payload, priority).result()
+
+    def _next_ready(self):
+        """Pop the highest-priority item whose chat can send now, else return the wait."""
+        now = time.monotonic()
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+        for item in sorted(self.heap):
+            chat_wait = self.chat_wait(item, now)
+            if chat_wait <= 0:
+                self.heap.remove(item)
+                heapq.heapify(self.heap)
+                return item, 0.0
+            wait = chat_wait if wait <= 0 else min(wait, chat_wait)
+        return None, wait
+
+    def _take(self, item):
+        # Caller holds self.cond
+        now = time.monotonic()
+        self.global_bucket.take(now)
+        if item[3] == "sendMessage":
+            self.chat_bucket(str(item[4].get("chat_id"))).take(now)
+        stats_gauge("tg.queue_len", len(self.heap))
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                item, wait = None, None
+                while item is None:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    item, wait = self._next_ready()
+                    if item is None:
+                        self.cond.wait(timeout=wait)
+                self._take(item)
+            stats_observe("tg.wait_s", time.monotonic() - item[2])
+            self.pool.submit(self._send, item)
+
+    async def _aloop(self):
+        while True:
+            self.wakeup.clear()  # before looking, so a submit in between isn't missed
+            with self.cond:
+                item, wait = self._next_ready() if self.heap else (None, None)
+                if item is not None:
+                    self._take(item)
+            if item is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            stats_observe("tg.wait_s", time.monotonic() - item[2])
+            _spawn(self._asend(item))
+
+    def _send(self, item):
+        try:
+            data = self.poster(item[3], item[4])
+        except Exception as e:
+            data = {"ok": False, "description": str(e)}
+        self._finish(item, data)
+
+    async def _asend(self, item):
+        try:
+            data = await self.apost(item[3], item[4])
+        except Exception as e:
+            data = {"ok": False, "description": str(e)}
+        self._finish(item, data)
+
+    def _finish(self, item, data: dict):
+        priority, _, enqueued_at, method, payload, future, attempts = item
+        retry_after = (data.get("parameters") or {}).get("retry_after") if data.get("error_code") == 429 else None
+        if retry_after and attempts < 3:
+            stats_inc("tg.429")
+            logger.warning(f"{method} 429 chat={payload.get('chat_id')}: retry in {retry_after}s")
+            with self.cond:
+                self.chat_bucket(str(payload.get("chat_id"))).blocked_until = time.monotonic() + float(retry_after)
+            self.submit(method, payload, priority, attempts + 1, future, enqueued_at)
+            return
+        future.set_result(data)
+
+outbox = TelegramOutbox(TG_SEND_WORKERS)
+
+
+# -------------------- MESSAGE CLEANUP --------------------
+class CleanupQueue:
+    """
+    All scheduled message deletions on one thread: a min-heap of
+    (due_unix_ts, chat_id, message_id) instead of a Timer thread per reply.
+    Everything due (within CLEANUP_COALESCE_SECONDS) is grouped per chat and
+    handed to the deleter as one list, so it can use deleteMessages.
+    Changes mark the heap dirty and the cleanup thread writes it to
+    CLEANUP_FILE (off the request path; adds that arrive during a write go
+    out in the next one), so after a restart pending deletions are reloaded
+    and overdue ones run immediately.
+    Bounded at max_pending; deletions beyond that are dropped (and logged).
+    """
+
+    def __init__(self, path: Path, max_pending: int):
+        self.path = path
+        self.max_pending = max_pending
+        self.heap: list[tuple[float, str, int]] = []
+        self.cond = threading.Condition()
+        self.deleter = telegram_delete_messages  # (chat_id, [message_id, ...])
+        self.thread = None
+        self.dirty = False
+        self.save_lock = threading.Lock()
+
+    def load(self):
+        try:
+            if self.path.exists():
+                items = [(float(d), str(c), int(m)) for d, c, m in json.loads(self.path.read_text(encoding="utf-8"))]
+                with self.cond:
+                    self.heap = items[: self.max_pending]
+                    heapq.heapify(self.heap)
+                logger.info(f"Cleanup: restored {len(self.heap)} pending deletions")
+        except Exception as e:
+            logger.warning(f"Cleanup: could not restore {self.path.name}: {e}")
+
+    def _save(self, items: list[tuple[float, str, int]]):
+        with self.save_lock:
+            try:
+                tmp = self.path.with_suffix(".tmp")
+                tmp.write_text(json.dumps(items), encoding="utf-8")
+                os.replace(tmp, self.path)
+                stats_inc("cleanup.saves")
+            except Exception as e:
+                logger.warning(f"Cleanup: could not persist: {e}")
+
+    def flush(self):
+        with self.cond:
+            if not self.dirty:
+                return
+            items, self.dirty = list(self.heap), False
+        self._save(items)
+
+    def add(self, chat_id: str, msg_ids: list[int], delay_seconds: float):
+        due = time.time() + delay_seconds
+        with self.cond:
+            room = self.max_pending - len(self.heap)
+            if room < len(msg_ids):
+                stats_inc("cleanup.dropped", len(msg_ids) - max(room, 0))
+                logger.warning(f"Cleanup queue full ({self.max_pending}); not deleting {msg_ids[max(room, 0):]}")
+                msg_ids = msg_ids[: max(room, 0)]
+            for mid in msg_ids:
+                heapq.heappush(self.heap, (due, str(chat_id), int(mid)))
+            self.dirty = True
+            stats_gauge("cleanup.pending", len(self.heap))
+            self.cond.notify()
+
+    def start(self, deleter=None):
+        if deleter:
+            self.deleter = deleter
+        self.load()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop, name="cleanup", daemon=True)
+            self.thread.start()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.dirty and (not self.heap or self.heap[0][0] > time.time()):
+                    self.cond.wait(timeout=self.heap[0][0] - time.time() if self.heap else None)
+                by_chat: dict[str, list[int]] = {}
+                if self.heap and self.heap[0][0] <= time.time():
+                    horizon = time.time() + CLEANUP_COALESCE_SECONDS
+                    while self.heap and self.heap[0][0] <= horizon:
+                        _, chat_id, mid = heapq.heappop(self.heap)
+                        by_chat.setdefault(chat_id, []).append(mid)
+                    self.dirty = True
+                stats_gauge("cleanup.pending", len(self.heap))
+            self.flush()
+
+            for chat_id, mids in by_chat.items():
+                try:
+                    self.deleter(chat_id, mids)
+                except Exception as e:
+                    logger.warning(f"Cleanup delete failed chat={chat_id} msgs={mids}: {e}")
+
+cleanup_queue = CleanupQueue(CLEANUP_FILE, CLEANUP_MAX_PENDING)
+atexit.register(cleanup_queue.flush)
+
 
 # -------------------- UI (KEYBOARDS) --------------------
 def kb_wallet_menu():
@@ -204,99 +1236,756 @@ def kb_wallet_menu():
 
 
 # -------------------- BYBIT CLIENT --------------------
+WALLET_ACCOUNT_TYPES = ["UNIFIED", "CONTRACT", "SPOT"]
+WALLET_COINS = "USDT,USDC,BTC,ETH"
+
+# Bybit v5 needs settleCoin or symbol; we try common settleCoins
+POSITION_ATTEMPTS = [("linear", "USDT"), ("linear", "USDC"), ("inverse", "BTC"), ("inverse", "USDT")]
+
+def wallet_result(data: dict, acct: str):
+    """
+    Interpret one wallet-balance response.
+    Returns (account, None, acct) on success, (None, err, acct) on an empty
+    success, or None when this account type failed and the next should be tried.
+    """
+    if data.get("retCode") == 0:
+        lst = (data.get("result") or {}).get("list") or []
+        if lst:
+            return lst[0], None, acct
+        return None, "Empty response", acct
+    return None
+
+def wallet_error(data: dict, acct: str) -> str:
+    return f"{data.get('retMsg')} (retCode={data.get('retCode')}, acct={acct})"
+
+# Max page sizes for cursor-paginated list endpoints
+POSITION_PAGE_LIMIT = 200
+
+
+class BybitError(Exception):
+    """Non-zero retCode from a Bybit v5 endpoint."""
+
+    def __init__(self, ret_msg, ret_code):
+        super().__init__(f"{ret_msg} (retCode={ret_code})")
+        self.ret_msg = ret_msg
+        self.ret_code = ret_code
+
+def list_page(data: dict):
+    """Returns (rows, next_cursor) for one page of a v5 list response."""
+    if data.get("retCode") != 0:
+        raise BybitError(data.get("retMsg"), data.get("retCode"))
+    result = data.get("result") or {}
+    return result.get("list") or [], result.get("nextPageCursor") or None
+
+def page_params(query_params: dict, limit: int, cursor: str | None) -> dict:
+    params = {**query_params, "limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+    return params
+
+def leg_error(e: Exception, category: str, settle: str) -> str:
+    if isinstance(e, BybitError):
+        return f"{e.ret_msg} (retCode={e.ret_code}, {category}/{settle})"
+    return f"{e} ({category}/{settle})"
+
+def positions_from_rows(rows, category: str) -> list[dict]:
+    """Open (size > 0) positions from position-list rows."""
+    positions = []
+    for p in rows:
+        try:
+            if float(p.get("size") or 0) > 0:
+                positions.append({
+                    "symbol": p.get("symbol"),
+                    "side": p.get("side"),
+                    "size": p.get("size"),
+                    "upl": p.get("unrealisedPnl"),
+                    "category": category,
+                    "idx": p.get("positionIdx", 0),
+                })
+        except Exception:
+            pass
+    return positions
+
+def merge_position_legs(legs: list[tuple]):
+    """
+    Combine per-(category, settleCoin) results into (positions, err).
+    err names a failed leg even when other legs answered, so callers can tell
+    a partial position list from a complete one.
+    """
+    positions = []
+    last_err = None
+    for leg, err in legs:
+        if err:
+            last_err = err
+            continue
+        positions.extend(leg)
+
+    if not positions and last_err:
+        return None, last_err
+    return positions, last_err
+
+
+bybit_pool = ThreadPoolExecutor(max_workers=BYBIT_FANOUT_WORKERS, thread_name_prefix="bybit")
+
+
+class BybitRateGovernor:
+    """
+    Client-side throttle so calls queue instead of failing with retCode 10006.
+      * per IP: at most BYBIT_IP_LIMIT requests per BYBIT_IP_WINDOW_SECONDS (sliding window)
+      * per API key + endpoint: the quota from X-Bapi-Limit-Status /
+        X-Bapi-Limit-Reset-Timestamp; once remaining falls to BYBIT_QUOTA_RESERVE,
+        callers wait for the reset
+    reserve() either books a slot and returns 0, or returns how long to wait.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.ip_calls: deque = deque()
+        self.quota: dict[tuple, dict] = {}  # (key_id, path) -> {"remaining", "limit", "reset"}
+
+    def reserve(self, key_id: str | None, path: str) -> float:
+        with self.cond:
+            now = time.time()
+            while self.ip_calls and self.ip_calls[0] <= now - BYBIT_IP_WINDOW_SECONDS:
+                self.ip_calls.popleft()
+            wait = 0.0
+            if len(self.ip_calls) >= BYBIT_IP_LIMIT:
+                wait = self.ip_calls[0] + BYBIT_IP_WINDOW_SECONDS - now
+            q = self.quota.get((key_id, path)) if key_id else None
+            if q and q["reset"] > now and q["remaining"] <= BYBIT_QUOTA_RESERVE:
+                wait = max(wait, q["reset"] - now)
+            if wait > 0:
+                return wait
+            self.ip_calls.append(now)
+            if q and q["reset"] > now:
+                q["remaining"] -= 1  # book it before the response tells us
+            return 0.0
+
+    def acquire(self, key_id: str | None, path: str):
+        started = time.monotonic()
+        while True:
+            wait = self.reserve(key_id, path)
+            if wait <= 0:
+                break
+            stats_inc("bybit.throttled")
+            with self.cond:
+                self.cond.wait(timeout=wait)
+        stats_observe("bybit.throttle_wait_s", time.monotonic() - started)
+
+    async def aacquire(self, key_id: str | None, path: str):
+        while True:
+            wait = self.reserve(key_id, path)
+            if wait <= 0:
+                return
+            stats_inc("bybit.throttled")
+            await asyncio.sleep(wait)
+
+    def update(self, key_id: str | None, path: str, headers, data: dict | None = None):
+        status = headers.get("X-Bapi-Limit-Status")
+        reset = headers.get("X-Bapi-Limit-Reset-Timestamp")
+        if not key_id or status is None or reset is None:
+            return
+        try:
+            remaining = int(status)
+            if data and data.get("retCode") == 10006:
+                remaining = 0  # rate limited: hold everything until the reset
+            q = {"remaining": remaining, "limit": int(headers.get("X-Bapi-Limit") or 0), "reset": int(reset) / 1000}
+        except ValueError:
+            return
+        with self.cond:
+            self.quota[(key_id, path)] = q
+            self.cond.notify_all()
+        stats_gauge(f"bybit.quota.{key_id}.{path}", q["remaining"])
+
+bybit_governor = BybitRateGovernor()
+
+def bybit_public_get(path: str, params: dict, timeout=10) -> dict:
+    def attempt():
+        bybit_governor.acquire(None, path)
+        return bybit_checked(response_json(http_request("GET", f"{BYBIT_BASE_URL}{path}", params=params, timeout=timeout)))
+    return singleflight.do(
+        flight_key(path, params),
+        lambda: resilient_call(f"bybit{path}", attempt, bybit_fallback),
+    )
+
+def log_position_legs(timings: dict):
+    for (category, settle), secs in timings.items():
+        stats_observe("bybit.position_leg_s", secs)
+    logger.debug("position legs: " + ", ".join(f"{c}/{s}={t * 1000:.0f}ms" for (c, s), t in timings.items()))
+
+
 class BybitClient:
-    def __init__(self, api_key: str, api_secret: str, base_url: str):
+    def __init__(self, api_key: str, api_secret: str, base_url: str, account_type: str | None = None):
         self.api_key = api_key
         self.api_secret = api_secret
         self.base_url = base_url
-
-    def sign_get(self, path: str, query_params: dict, recv_window="5000"):
+        self.key_id = api_key[-6:]  # safe to log / persist
+        # Last accountType that answered wallet-balance; tried first until re-probe
+        self.account_type = account_type
+        self.account_type_at = time.time() if account_type else 0.0
+
+    def wallet_account_order(self) -> list[str]:
+        if self.account_type and time.time() - self.account_type_at < ACCOUNT_TYPE_REPROBE_SECONDS:
+            return [self.account_type] + [a for a in WALLET_ACCOUNT_TYPES if a != self.account_type]
+        # Periodic re-probe in default order (e.g. an account upgraded to UNIFIED)
+        return WALLET_ACCOUNT_TYPES
+
+    def remember_account_type(self, acct: str):
+        changed = acct != self.account_type
+        self.account_type = acct
+        self.account_type_at = time.time()
+        if changed:
+            save_account_type(self.key_id, acct)
+
+    def auth_headers(self, query_params: dict, recv_window="5000") -> dict:
         ts = str(int(time.time() * 1000))
         qs = urlencode(query_params, doseq=True)
         sign_str = f"{ts}{self.api_key}{recv_window}{qs}"
         sig = hmac.new(self.api_secret.encode(), sign_str.encode(), hashlib.sha256).hexdigest()
 
-        headers = {
+        return {
             "X-BAPI-API-KEY": self.api_key,
             "X-BAPI-TIMESTAMP": ts,
             "X-BAPI-RECV-WINDOW": recv_window,
             "X-BAPI-SIGN": sig,
         }
-        r = requests.get(f"{self.base_url}{path}", params=query_params, headers=headers, timeout=20)
-        return r.json()
+
+    def sign_get(self, path: str, query_params: dict, recv_window="5000", deadline: float | None = None):
+        def attempt():
+            bybit_governor.acquire(self.key_id, path)
+            headers = self.auth_headers(query_params, recv_window)  # sign after any wait, per attempt
+            timeout = deadline_timeout(deadline, BYBIT_HTTP_TIMEOUT)
+            r = http_request("GET", f"{self.base_url}{path}", params=query_params, headers=headers, timeout=timeout)
+            data = response_json(r)
+            bybit_governor.update(self.key_id, path, r.headers, data)
+            return bybit_checked(data)
+        return singleflight.do(
+            flight_key(path, query_params, self.api_key),
+            lambda: resilient_call(f"bybit{path}", attempt, bybit_fallback, deadline=deadline),
+        )
+
+    def iter_list(self, path: str, query_params: dict, limit: int, deadline: float | None = None):
+        """
+        Lazily yield rows of a cursor-paginated v5 list endpoint, fetching the
+        next page (at `limit` rows, the endpoint max) only when it's reached.
+        Raises BybitError on a non-zero retCode.
+        """
+        cursor = None
+        seen = set()
+        while True:
+            page = self.sign_get(path, page_params(query_params, limit, cursor), deadline=deadline)
+            rows, cursor = list_page(page)
+            yield from rows
+            if not cursor or cursor in seen:
+                return
+            seen.add(cursor)
 
     def wallet_best(self):
-        # Try common account types
+        # Learned account type first, then the other common ones
         last = None
-        for acct in ["UNIFIED", "CONTRACT", "SPOT"]:
-            data = self.sign_get("/v5/account/wallet-balance", {"accountType": acct, "coin": "USDT,USDC,BTC,ETH"})
-            if data.get("retCode") == 0:
-                lst = (data.get("result") or {}).get("list") or []
-                if lst:
-                    return lst[0], None, acct
-                return None, "Empty response", acct
-            last = f"{data.get('retMsg')} (retCode={data.get('retCode')}, acct={acct})"
+        for acct in self.wallet_account_order():
+            data = self.sign_get("/v5/account/wallet-balance", {"accountType": acct, "coin": WALLET_COINS})
+            res = wallet_result(data, acct)
+            if res:
+                self.remember_account_type(acct)
+                return res
+            last = wallet_error(data, acct)
         return None, last, None
 
     def open_positions_all(self):
-        # Bybit v5 needs settleCoin or symbol; we try common settleCoins
-        attempts = [("linear", "USDT"), ("linear", "USDC"), ("inverse", "BTC"), ("inverse", "USDT")]
-        positions = []
-        last_err = None
-
-        for category, settle in attempts:
-            data = self.sign_get("/v5/position/list", {"category": category, "settleCoin": settle})
-            if data.get("retCode") != 0:
-                last_err = f"{data.get('retMsg')} (retCode={data.get('retCode')}, {category}/{settle})"
-                continue
-
-            lst = (data.get("result") or {}).get("list") or []
-            for p in lst:
-                try:
-                    if float(p.get("size") or 0) > 0:
-                        positions.append({
-                            "symbol": p.get("symbol"),
-                            "side": p.get("side"),
-                            "size": p.get("size"),
-                            "upl": p.get("unrealisedPnl"),
-                        })
-                except Exception:
-                    pass
-
-        if not positions and last_err:
-            return None, last_err
-        return positions, None
+        # All legs run concurrently; whatever hasn't answered by the shared
+        # deadline is reported as a timed-out leg and the rest is returned.
+        # Legs get HTTP timeouts capped at the deadline and don't retry past it,
+        # so a late leg frees its pool worker soon after being abandoned.
+        deadline = time.monotonic() + POSITIONS_DEADLINE_SECONDS
+
+        def leg(category, settle):
+            t0 = time.perf_counter()
+            try:
+                params = {"category": category, "settleCoin": settle}
+                rows = self.iter_list("/v5/position/list", params, POSITION_PAGE_LIMIT, deadline=deadline)
+                return (positions_from_rows(rows, category), None), time.perf_counter() - t0
+            except Exception as e:
+                return ([], leg_error(e, category, settle)), time.perf_counter() - t0
+
+        futures = {bybit_pool.submit(leg, c, s): (c, s) for c, s in POSITION_ATTEMPTS}
+        futures_wait(futures, timeout=POSITIONS_DEADLINE_SECONDS)
+
+        legs = []
+        timings = {}
+        for fut, (category, settle) in futures.items():
+            if fut.done():
+                result, timings[(category, settle)] = fut.result()
+                legs.append(result)
+            else:
+                stats_inc("bybit.position_leg_timeouts")
+                logger.warning(f"position leg {category}/{settle} missed the {POSITIONS_DEADLINE_SECONDS}s deadline")
+                legs.append(([], f"timed out ({category}/{settle})"))
+        log_position_legs(timings)
+        return merge_position_legs(legs)
 
 
 def load_users(max_users=10):
     users = {}
+    account_types = load_account_types()
     for i in range(1, max_users + 1):
         uid = os.getenv(f"BYBIT_USER_{i}_ID")
         key = os.getenv(f"BYBIT_USER_{i}_KEY")
         sec = os.getenv(f"BYBIT_USER_{i}_SECRET")
         if uid and key and sec:
-            users[int(uid)] = BybitClient(key, sec, BYBIT_BASE_URL)
+            users[int(uid)] = BybitClient(key, sec, BYBIT_BASE_URL, account_types.get(key[-6:]))
     return users
 
-USERS = load_users()
+USERS: dict[int, BybitClient] = {}  # loaded in main(); reading learned account types opens the state DB
 
 def get_client_for_user(user_id: int) -> BybitClient | None:
     return USERS.get(user_id)
 
 
 # -------------------- MARKET PRICE (FOR /pnl POSITIONS) --------------------
-def bybit_get_ticker_price(symbol: str):
+def ticker_price(t: dict):
+    """Returns (price_float, "mark"/"last") for one ticker row, or (None, None)."""
+    mark = t.get("markPrice")
+    last = t.get("lastPrice")
+
+    if mark and float(mark) > 0:
+        return float(mark), "mark"
+    if last and float(last) > 0:
+        return float(last), "last"
+    return None, None
+
+# symbol -> category, learned from ticker lists and positions
+ticker_symbol_category: dict[str, str] = {}
+
+def ticker_categories(symbol: str, category: str | None = None) -> list[str]:
+    """Categories to search for symbol: the known one first, else linear then inverse."""
+    known = category or ticker_symbol_category.get(symbol)
+    if known:
+        return [known] + [c for c in ["linear", "inverse"] if c != known]
+    return ["linear", "inverse"]
+
+def index_tickers(category: str, data: dict) -> dict[str, dict]:
+    """symbol -> ticker row for one category-wide tickers response."""
+    if data.get("retCode") != 0:
+        return {}
+    rows = {t.get("symbol"): t for t in (data.get("result") or {}).get("list") or []}
+    for sym in rows:
+        ticker_symbol_category[sym] = category
+    return rows
+
+def bybit_fetch_tickers(category: str) -> dict[str, dict]:
+    try:
+        return index_tickers(category, bybit_public_get("/v5/market/tickers", {"category": category}))
+    except Exception as e:
+        logger.warning(f"tickers {category} failed: {e}")
+        return {}
+
+def resolve_prices(symbols: list[str], categories: dict, tables: dict) -> dict[str, tuple]:
+    out = {}
+    for sym in symbols:
+        out[sym] = (None, None)
+        for category in ticker_categories(sym, categories.get(sym)):
+            t = tables.get(category, {}).get(sym)
+            if t:
+                out[sym] = ticker_price(t)
+                break
+    return out
+
+def ticker_categories_needed(symbols: list[str], categories: dict) -> set[str]:
+    needed = set()
+    for sym in symbols:
+        known = categories.get(sym) or ticker_symbol_category.get(sym)
+        needed.update([known] if known else ["linear", "inverse"])
+    return needed
+
+class TickerCache:
+    """
+    In-process market data shared by /pnl and the BTC alert: the latest
+    category-wide ticker list per category, indexed by symbol. A scheduler
+    job refreshes every category periodically; readers can check age()
+    and pass max_age to force a refresh of data that is too old.
+    """
+
+    def __init__(self, categories: list[str]):
+        self.categories = categories
+        self.tables: dict[str, dict[str, dict]] = {}
+        self.updated: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def store(self, category: str, rows: dict[str, dict]):
+        if not rows:
+            return
+        with self.lock:
+            self.tables[category] = rows
+            self.updated[category] = time.monotonic()
+
+    def age(self, category: str) -> float:
+        """Seconds since category was last refreshed (inf if never)."""
+        with self.lock:
+            at = self.updated.get(category)
+        return time.monotonic() - at if at is not None else float("inf")
+
+    def refresh(self, category: str):
+        self.store(category, bybit_fetch_tickers(category))
+
+    def tables_for(self, categories, max_age: float = TICKER_MAX_AGE_SECONDS) -> dict[str, dict]:
+        """symbol tables for categories, refreshing (concurrently) any older than max_age."""
+        stale = [c for c in categories if self.age(c) > max_age]
+        for f in [bybit_pool.submit(self.refresh, c) for c in stale]:
+            f.result()
+        with self.lock:
+            return {c: self.tables.get(c, {}) for c in categories}
+
+    def get(self, symbol: str, category: str | None = None, max_age: float = TICKER_MAX_AGE_SECONDS):
+        """Returns (ticker_row, category, age_seconds) or (None, None, None)."""
+        for c in ticker_categories(symbol, category):
+            row = self.tables_for([c], max_age)[c].get(symbol)
+            if row:
+                return row, c, self.age(c)
+        return None, None, None
+
+    def refresh_all(self, categories=None):
+        for f in [bybit_pool.submit(self.refresh, c) for c in (self.categories if categories is None else categories)]:
+            f.result()
+
+ticker_cache = TickerCache(["linear", "inverse"])
+
+
+# -------------------- LIVE PRICES (BYBIT PUBLIC WEBSOCKET) --------------------
+class BybitStream:
+    """
+    One Bybit v5 WebSocket connection on a daemon thread. (Re)subscribes its
+    topics on every connect, pings every WS_PING_SECONDS, treats silence past
+    three ping intervals as a dead link and reconnects with exponential backoff.
+    Subclasses handle topic messages in on_message().
+    """
+
+    def __init__(self, url: str, name: str):
+        self.url = url
+        self.name = name
+        self.topics: set[str] = set()
+        self.ws = None
+        self.connected = False
+        self.last_msg_at = 0.0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self) -> bool:
+        if websocket is None:
+            logger.warning(f"WS {self.name}: websocket-client not installed, staying on REST")
+            return False
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=f"ws-{self.name}", daemon=True)
+            self.thread.start()
+        return True
+
+    def subscribe(self, topics):
+        with self.lock:
+            new = set(topics) - self.topics
+            if not new:
+                return
+            self.topics |= new
+            if self.connected:
+                self._send({"op": "subscribe", "args": sorted(new)})
+
+    def _send(self, msg: dict):
+        try:
+            self.ws.send(json.dumps(msg))
+        except Exception as e:
+            logger.warning(f"WS {self.name} send failed: {e}")
+
+    def healthy(self) -> bool:
+        return self.connected and time.monotonic() - self.last_msg_at < 3 * WS_PING_SECONDS
+
+    def on_connect(self):
+        """Runs right after connecting, before topics are subscribed (e.g. auth)."""
+
+    def on_control(self, msg: dict):
+        """Non-topic replies (auth/subscribe/pong)."""
+        if msg.get("success") is False:
+            logger.warning(f"WS {self.name} {msg.get('op')} failed: {msg.get('ret_msg')}")
+
+    def on_tick(self):
+        """Runs on the stream thread between reads."""
+
+    def on_message(self, msg: dict):
+        raise NotImplementedError
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                self.ws = websocket.create_connection(self.url, timeout=WS_PING_SECONDS / 2)
+                self.last_msg_at = time.monotonic()
+                self.on_connect()
+                with self.lock:
+                    self.connected = True
+                    if self.topics:
+                        self._send({"op": "subscribe", "args": sorted(self.topics)})
+                stats_inc(f"ws.{self.name}.connects")
+                logger.info(f"WS {self.name} connected ({len(self.topics)} topics)")
+                backoff = 1.0
+                self._read()
+            except Exception as e:
+                logger.warning(f"WS {self.name} disconnected: {e}")
+            finally:
+                with self.lock:
+                    self.connected = False
+                try:
+                    self.ws.close()
+                except Exception:
+                    pass
+
+            stats_inc(f"ws.{self.name}.reconnects")
+            time.sleep(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, WS_RECONNECT_MAX_SECONDS)
+
+    def _read(self):
+        last_ping = time.monotonic()
+        while True:
+            if time.monotonic() - last_ping >= WS_PING_SECONDS:
+                self._send({"op": "ping"})
+                last_ping = time.monotonic()
+            self.on_tick()
+            try:
+                raw = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                if time.monotonic() - self.last_msg_at > 3 * WS_PING_SECONDS:
+                    raise ConnectionError("heartbeat lost")
+                continue
+            if not raw:
+                raise ConnectionError("closed by server")
+
+            self.last_msg_at = time.monotonic()
+            msg = json.loads(raw)
+            if "topic" in msg:
+                self.on_message(msg)
+            else:
+                self.on_control(msg)
+
+
+class PublicTickerStream(BybitStream):
+    """tickers.<symbol> stream for one category, merged into a live price book."""
+
+    def __init__(self, category: str):
+        super().__init__(f"{BYBIT_WS_PUBLIC_URL}/{category}", f"public.{category}")
+        self.category = category
+        self.book: dict[str, dict] = {}
+        self.book_at: dict[str, float] = {}
+
+    def on_message(self, msg: dict):
+        if not msg.get("topic", "").startswith("tickers."):
+            return
+        data = msg.get("data") or {}
+        sym = data.get("symbol")
+        if not sym:
+            return
+        with self.lock:
+            # Snapshots carry every field; deltas only the ones that changed
+            row = data if msg.get("type") == "snapshot" else {**self.book.get(sym, {}), **data}
+            self.book[sym] = row
+            self.book_at[sym] = time.monotonic()
+
+    def get(self, symbol: str) -> dict | None:
+        """Live ticker row, or None if missing or older than WS_STALE_SECONDS."""
+        with self.lock:
+            at = self.book_at.get(symbol)
+            if not self.connected or at is None or time.monotonic() - at > WS_STALE_SECONDS:
+                return None
+            return self.book.get(symbol)
+
+
+class PriceFeed:
+    """Live prices for the symbols we care about; get() returns None so callers fall back to REST."""
+
+    def __init__(self, categories: list[str]):
+        self.streams = {c: PublicTickerStream(c) for c in categories}
+        self.running = False
+
+    def start(self, symbols: dict[str, str]):
+        """symbols: {symbol: category} to subscribe immediately."""
+        self.running = all([s.start() for s in self.streams.values()])
+        for sym, category in symbols.items():
+            self.want(sym, category)
+
+    def want(self, symbol: str, category: str | None = None):
+        if not self.running:
+            return
+        category = category or ticker_symbol_category.get(symbol)
+        if category in self.streams:
+            self.streams[category].subscribe([f"tickers.{symbol}"])
+
+    def live(self, category: str) -> bool:
+        return self.running and category in self.streams and self.streams[category].healthy()
+
+    def get(self, symbol: str, category: str | None = None) -> dict | None:
+        if not self.running:
+            return None
+        for c in ticker_categories(symbol, category):
+            row = self.streams[c].get(symbol) if c in self.streams else None
+            if row:
+                stats_inc("prices.ws_hits")
+                return row
+        return None
+
+    def prices(self, symbols: list[str], categories: dict) -> dict[str, tuple]:
+        """{symbol: (price, src)} for symbols with a live price; subscribes the rest."""
+        out = {}
+        for sym in symbols:
+            row = self.get(sym, categories.get(sym))
+            price = ticker_price(row) if row else (None, None)
+            if price[0] is not None:
+                out[sym] = price
+            else:
+                self.want(sym, categories.get(sym))
+        return out
+
+price_feed = PriceFeed(["linear", "inverse"])
+
+def rest_ticker_categories() -> list[str]:
+    """
+    Categories the periodic REST ticker refresh still has to poll: those the
+    live feed isn't covering (off, connecting or gone quiet). Symbols a live
+    category hasn't subscribed yet are fetched on read via max_age.
+    """
+    return [c for c in ticker_cache.categories if not price_feed.live(c)]
+
+
+# -------------------- LIVE ACCOUNT (BYBIT PRIVATE WEBSOCKET) --------------------
+class PrivateAccountStream(BybitStream):
+    """
+    One user's position + wallet topics kept as a local account model.
+    The model is seeded from REST on every (re)connect and every
+    ACCOUNT_RESEED_SECONDS, then patched by stream messages in between.
+    """
+
+    def __init__(self, user_id: int, client: BybitClient):
+        super().__init__(BYBIT_WS_PRIVATE_URL, f"private.{user_id}")
+        self.user_id = user_id
+        self.client = client
+        self.topics = {"position", "wallet"}
+        self.authed = False
+        self.acct: str | None = None
+        self.wallet: dict | None = None  # same shape as a wallet-balance list row
+        self.positions: dict[tuple, dict] = {}  # (category, symbol, positionIdx) -> position
+        self.seeded_at = 0.0
+
+    def on_connect(self):
+        self.authed = False
+        self.seed()
+        expires = int((time.time() + 10) * 1000)
+        sig = hmac.new(self.client.api_secret.encode(), f"GET/realtime{expires}".encode(), hashlib.sha256).hexdigest()
+        self._send({"op": "auth", "args": [self.client.api_key, expires, sig]})
+
+    def on_control(self, msg: dict):
+        if msg.get("op") == "auth":
+            self.authed = bool(msg.get("success"))
+        super().on_control(msg)
+
+    def on_tick(self):
+        if time.monotonic() - self.seeded_at >= ACCOUNT_RESEED_SECONDS:
+            self.seed()
+
+    def seed(self):
+        acc, err, acct = self.client.wallet_best()
+        positions, perr = self.client.open_positions_all()
+        if err or perr:
+            logger.warning(f"WS {self.name} seed failed: {err or perr}")
+            return
+        with self.lock:
+            self.acct = acct
+            self.wallet = acc
+            self.positions = {(p["category"], p["symbol"], p["idx"]): p for p in positions or []}
+            self.seeded_at = time.monotonic()
+
+    def on_message(self, msg: dict):
+        topic = msg.get("topic")
+        if topic in self.topics:
+            snapshot_cache.invalidate(self.user_id)  # the REST snapshot predates this event
+        with self.lock:
+            if topic == "position":
+                for row in msg.get("data") or []:
+                    category = row.get("category") or "linear"
+                    key = (category, row.get("symbol"), row.get("positionIdx", 0))
+                    opened = positions_from_rows([row], category)
+                    if opened:
+                        self.positions[key] = opened[0]
+                    else:
+                        self.positions.pop(key, None)
+            elif topic == "wallet":
+                for row in msg.get("data") or []:
+                    if row.get("accountType") == self.acct:
+                        self.wallet = {**(self.wallet or {}), **row}
+
+    def metrics(self):
+        """(metrics, None) from the local model, or None when it can't be trusted."""
+        with self.lock:
+            live = (
+                self.connected and self.authed and self.wallet is not None
+                and time.monotonic() - self.last_msg_at < 3 * WS_PING_SECONDS
+                and time.monotonic() - self.seeded_at < 2 * ACCOUNT_RESEED_SECONDS
+            )
+            if not live:
+                return None
+            positions = list(self.positions.values())
+            return build_trade_metrics(self.wallet, self.acct, positions, None), None
+
+account_streams: dict[int, PrivateAccountStream] = {}
+
+def start_account_streams():
+    for user_id, client in USERS.items():
+        stream = account_streams[user_id] = PrivateAccountStream(user_id, client)
+        stream.start()
+
+def live_account_metrics(user_id: int):
+    """(metrics, None) from the user's private stream, or None to fall back to REST."""
+    stream = account_streams.get(user_id)
+    result = stream.metrics() if stream else None
+    stats_inc("account.ws_hits" if result else "account.ws_misses")
+    return result
+
+
+def bybit_get_ticker_prices(symbols: list[str], categories: dict | None = None,
+                            max_age: float = TICKER_MAX_AGE_SECONDS) -> dict[str, tuple]:
+    """
+    Batch price lookup: live WebSocket prices first, then the ticker cache (one
+    category-wide tickers call per category, and only when that category is
+    older than max_age). Symbols with a known category (passed in or learned)
+    only pull that category.
+    Returns {symbol: (price, "mark"/"last") or (None, None)}.
+    """
+    categories = categories or {}
+    live = price_feed.prices(symbols, categories)
+    rest = [sym for sym in symbols if sym not in live]
+    if not rest:
+        return live
+    tables = ticker_cache.tables_for(ticker_categories_needed(rest, categories), max_age)
+    for sym in rest:
+        price_feed.want(sym, categories.get(sym))  # category is known now
+    return {**resolve_prices(rest, categories, tables), **live}
+
+def bybit_get_ticker_price(symbol: str, max_age: float = TICKER_MAX_AGE_SECONDS):
     """
     Fetch current price for symbol (prefer markPrice; fallback lastPrice).
-    Tries linear first (USDT/USDC perps), then inverse.
+    Reads the live WebSocket book, then the shared ticker cache; symbols missing
+    from both are queried directly, trying the known category first, else
+    linear (USDT/USDC perps), then inverse.
     Returns: (price_float, "mark"/"last") or (None, None)
     """
-    for category in ["linear", "inverse"]:
+    live = price_feed.prices([symbol], {})
+    if symbol in live:
+        return live[symbol]
+
+    row, _, _ = ticker_cache.get(symbol, max_age=max_age)
+    price_feed.want(symbol)  # category is known now if the cache had it
+    if row:
+        price, src = ticker_price(row)
+        if price is not None:
+            return price, src
+
+    for category in ticker_categories(symbol):
         try:
-            url = f"{BYBIT_BASE_URL}/v5/market/tickers"
-            params = {"category": category, "symbol": symbol}
-            r = requests.get(url, params=params, timeout=10)
-            data = r.json()
+            data = bybit_public_get("/v5/market/tickers", {"category": category, "symbol": symbol})
             if data.get("retCode") != 0:
                 continue
 
@@ -304,14 +1993,10 @@ def bybit_get_ticker_price(symbol: str):
             if not lst:
                 continue
 
-            t = lst[0]
-            mark = t.get("markPrice")
-            last = t.get("lastPrice")
-
-            if mark and float(mark) > 0:
-                return float(mark), "mark"
-            if last and float(last) > 0:
-                return float(last), "last"
+            ticker_symbol_category[symbol] = category
+            price, src = ticker_price(lst[0])
+            if price is not None:
+                return price, src
         except Exception:
             continue
 
@@ -319,11 +2004,7 @@ def bybit_get_ticker_price(symbol: str):
 
 
 # -------------------- METRICS --------------------
-def compute_trade_metrics(client: BybitClient):
-    acc, err, acct = client.wallet_best()
-    if err:
-        return None, err
-
+def build_trade_metrics(acc: dict, acct: str, positions: list | None, perr: str | None) -> dict:
     def f(key):
         try:
             return float(acc.get(key) or 0)
@@ -346,9 +2027,8 @@ def compute_trade_metrics(client: BybitClient):
     # Bybit-reported asset figure
     assets_now = margin_balance if margin_balance > 0 else equity
 
-    positions, perr = client.open_positions_all()
     pnl_open = 0.0
-    if positions and not perr:
+    if positions:
         for p in positions:
             try:
                 pnl_open += float(p.get("upl") or 0)
@@ -375,47 +2055,155 @@ def compute_trade_metrics(client: BybitClient):
         "capital_free_real": capital_free_real,
         "equity_mtm": equity_mtm,
         "positions": positions or [],
-    }, None
+        "positions_complete": perr is None,  # False when a position leg failed or timed out
+    }
 
+def compute_trade_metrics(client: BybitClient):
+    acc, err, acct = client.wallet_best()
+    if err:
+        return None, err
 
-# -------------------- MTD PNL (MONTH-TO-DATE) --------------------
-def compute_mtd_pnl_for_user(user_id: int):
+    positions, perr = client.open_positions_all()
+    return build_trade_metrics(acc, acct, positions, perr), None
+
+
+# -------------------- ACCOUNT SNAPSHOT CACHE --------------------
+class SnapshotCache:
     """
-    Month-to-date profit% for the requesting user.
-    Baseline: start_wallet stored when month starts (first time bot sees new month).
-    Current: equity_mtm = wallet_balance + open_pnl (includes open trades).
+    Per-user (metrics, err) snapshots with a TTL and LRU eviction.
+    Only successful snapshots with every position leg answered are stored;
+    errors and partial snapshots are always retried.
     """
-    client = get_client_for_user(user_id)
-    if not client:
-        return None, "No API configured for you."
 
-    m, err = compute_trade_metrics(client)
-    if err:
-        return None, f"Bybit: {err}"
+    def __init__(self, ttl: float, stale: float, max_size: int):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_size = max_size
+        self.entries: OrderedDict[int, tuple[float, tuple]] = OrderedDict()  # key -> (stored_at, result)
+        self.refreshing: set[int] = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, key: int):
+        """Returns (result, "fresh" | "stale" | "miss")."""
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit is None:
+                return None, "miss"
+            self.entries.move_to_end(key)
+        age = time.monotonic() - hit[0]
+        if age < self.ttl:
+            return hit[1], "fresh"
+        if age < self.ttl + self.stale:
+            return hit[1], "stale"
+        return None, "miss"
+
+    def put(self, key: int, result: tuple):
+        if result[1] is not None or not result[0].get("positions_complete", True):
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: int):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get(self, key: int, loader):
+        """
+        Serve from memory when fresh; when stale, serve it and refresh in the
+        background; otherwise load synchronously.
+        """
+        result, state = self.lookup(key)
+        stats_inc(f"snapshot.{state}")
+        if state == "fresh":
+            return result
+        if state == "stale":
+            self.refresh_async(key, loader)
+            return result
+        result = loader()
+        self.put(key, result)
+        return result
+
+    def claim_refresh(self, key: int) -> bool:
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def release_refresh(self, key: int):
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def refresh_async(self, key: int, loader):
+        if not self.claim_refresh(key):
+            return
 
-    month = current_month_key()
-    key = str(user_id)
+        def _do():
+            try:
+                self.put(key, loader())
+            except Exception as e:
+                logger.warning(f"Snapshot refresh failed (user={key}): {e}")
+            finally:
+                self.release_refresh(key)
+
+        threading.Thread(target=_do, daemon=True).start()
 
-    data = load_monthly_data()
-    if key not in data:
-        data[key] = {}
+snapshot_cache = SnapshotCache(SNAPSHOT_TTL_SECONDS, SNAPSHOT_STALE_SECONDS, SNAPSHOT_CACHE_SIZE)
+
+
+class MetricsContext:
+    """
+    One command's view of a user's account. Trade metrics come from the
+    live private stream or the snapshot cache and are memoized, so every
+    formatter in the same command reads one snapshot.
+    """
 
-    # Migrate old key if needed
-    if data[key].get("month") == month and "start_wallet" not in data[key] and "start_equity" in data[key]:
-        data[key]["start_wallet"] = float(data[key]["start_equity"])
-        save_monthly_data(data)
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.client = get_client_for_user(user_id)
+        self._result = None
+
+    def metrics(self):
+        """Returns (metrics, err) exactly like compute_trade_metrics."""
+        if self._result is None:
+            if not self.client:
+                self._result = (None, "No API configured for you.")
+            else:
+                client = self.client
+                self._result = (
+                    live_account_metrics(self.user_id)
+                    or snapshot_cache.get(self.user_id, lambda: compute_trade_metrics(client))
+                )
+        return self._result
 
-    # New month => snapshot baseline wallet
-    if data[key].get("month") != month:
-        data[key] = {"month": month, "start_wallet": float(m["wallet_balance"])}
-        save_monthly_data(data)
 
-    start_wallet = float(data[key].get("start_wallet", float(m["wallet_balance"])))
+# -------------------- MTD PNL (MONTH-TO-DATE) --------------------
+def mtd_pnl_from_metrics(user_id: int, m: dict) -> dict:
+    """
+    Month-to-date figures for user_id given freshly computed trade metrics.
+    Snapshots the baseline wallet the first time a new month is seen.
+    """
+    month = current_month_key()
+    try:
+        # New month => snapshot baseline wallet
+        start_wallet = state_store.monthly_baseline(str(user_id), month, float(m["wallet_balance"]))
+    except Exception as e:
+        logger.warning(f"monthly baseline read failed user={user_id}: {e}")
+        start_wallet = float(m["wallet_balance"])
     start_equity = start_wallet  # baseline (simple and matches your expectation)
     now_equity = float(m["equity_mtm"])
 
     pct = ((now_equity - start_equity) / start_equity * 100) if start_equity > 0 else 0.0
 
+    try:
+        realized = closed_pnl_ledger.realized_total(str(user_id), *month_bounds_ms(month))
+    except Exception as e:
+        logger.warning(f"ledger read failed user={user_id}: {e}")
+        realized = None
+
     return {
         "month": month,
         "acct": m["acct"],
@@ -423,32 +2211,51 @@ def compute_mtd_pnl_for_user(user_id: int):
         "now_wallet": float(m["wallet_balance"]),
         "now_equity": now_equity,
         "pnl_open": float(m["pnl_open"]),
+        "realized": realized,
         "pct": pct,
-    }, None
+    }
 
+def compute_mtd_pnl_for_user(user_id: int, ctx: MetricsContext | None = None):
+    """
+    Month-to-date profit% for the requesting user.
+    Baseline: start_wallet stored when month starts (first time bot sees new month).
+    Current: equity_mtm = wallet_balance + open_pnl (includes open trades).
+    """
+    ctx = ctx or MetricsContext(user_id)
+    if not ctx.client:
+        return None, "No API configured for you."
 
-def fn_pnl(user_id: int) -> str:
-    r, err = compute_mtd_pnl_for_user(user_id)
+    m, err = ctx.metrics()
     if err:
-        return f"❌ {err}"
+        return None, f"Bybit: {err}"
 
-    # ✅ Add open assets + live price
-    pos_lines = []
-    client = get_client_for_user(user_id)
-    if client:
-        m, merr = compute_trade_metrics(client)
-        if not merr:
-            positions = [p for p in (m["positions"] or []) if float(p.get("size") or 0) > 0]
-            for p in positions[:3]:  # keep it clean
-                sym = p.get("symbol") or "?"
-                price, src = bybit_get_ticker_price(sym)
-                if price is None:
-                    pos_lines.append(f"• <b>{sym}</b> — price: n/a")
-                else:
-                    pos_lines.append(f"• <b>{sym}</b> — price: <b>{price:,.4f}</b> <i>({src})</i>")
-            if len(positions) > 3:
-                pos_lines.append(f"<i>+{len(positions)-3} more…</i>")
+    return mtd_pnl_from_metrics(user_id, m), None
+
+
+def pnl_open_positions(m: dict) -> list[dict]:
+    return [p for p in (m["positions"] or []) if float(p.get("size") or 0) > 0]
+
+def pnl_price_request(positions: list[dict]):
+    """(symbols, {symbol: category}) for the positions shown by /pnl."""
+    shown = positions[:3]  # keep it clean
+    symbols = [p.get("symbol") or "?" for p in shown]
+    categories = {p.get("symbol") or "?": p.get("category") for p in shown if p.get("category")}
+    return symbols, categories
 
+def pnl_position_lines(positions: list[dict], prices: dict[str, tuple]) -> list[str]:
+    pos_lines = []
+    for p in positions[:3]:  # keep it clean
+        sym = p.get("symbol") or "?"
+        price, src = prices.get(sym, (None, None))
+        if price is None:
+            pos_lines.append(f"• <b>{sym}</b> — price: n/a")
+        else:
+            pos_lines.append(f"• <b>{sym}</b> — price: <b>{price:,.4f}</b> <i>({src})</i>")
+    if len(positions) > 3:
+        pos_lines.append(f"<i>+{len(positions)-3} more…</i>")
+    return pos_lines
+
+def render_pnl(user_id: int, r: dict, pos_lines: list[str]) -> str:
     title = month_label(r["month"])
     emoji = "📈" if r["pct"] >= 0 else "📉"
 
@@ -456,23 +2263,444 @@ def fn_pnl(user_id: int) -> str:
     if pos_lines:
         positions_block = "\n\n<b>Open Assets</b>\n" + "\n".join(pos_lines)
 
+    realized_line = ""
+    if r.get("realized") is not None:
+        realized_line = f"Realized (closed trades): {fmt_usd(r['realized'])}\n"
+
     return (
         f"📊 <b>MTD PnL — {title}</b>\n\n"
         f"👤 <b>{user_id}</b> <i>{r['acct']}</i>\n"
         f"Start (baseline): {fmt_usd(r['start_equity'])}\n"
         f"Open PnL: {fmt_usd(r['pnl_open'])}\n"
+        f"{realized_line}"
         f"Now (equity): <b>{fmt_usd(r['now_equity'])}</b>\n"
         f"Result: {emoji} <b>{r['pct']:+.2f}%</b>"
         f"{positions_block}"
     )
 
+def fn_pnl(user_id: int, arg: str | None = None) -> str:
+    if arg:
+        return fn_pnl_range(user_id, arg)
+    ctx = MetricsContext(user_id)
+    r, err = compute_mtd_pnl_for_user(user_id, ctx)
+    if err:
+        return f"❌ {err}"
+
+    # ✅ Add open assets + live price (same snapshot as the MTD figures)
+    m, _ = ctx.metrics()
+    positions = pnl_open_positions(m)
+    prices = bybit_get_ticker_prices(*pnl_price_request(positions)) if positions else {}
+    pos_lines = pnl_position_lines(positions, prices)
+
+    return render_pnl(user_id, r, pos_lines)
+
+
+# -------------------- EQUITY HISTORY --------------------
+# One file per user and tier (equity/<user_id>.<tier>.bin) holding fixed-width
+# records sorted by bucket start. A sample overwrites the tier's last record
+# while it falls in the same bucket and appends one otherwise, so each tier
+# keeps the last value per minute / hour / day. Range reads bisect on the
+# bucket start and read the matching records in one slice.
+EQUITY_RECORD = struct.Struct("<Iddd")  # bucket start (unix s), equity_mtm, wallet_balance, pnl_open
+EQUITY_TIERS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+class EquitySeries:
+    def __init__(self, path: Path, width: int):
+        self.path = path
+        self.width = width
+        path.touch(exist_ok=True)
+        self.f = open(path, "r+b")
+        size = path.stat().st_size
+        torn = size % EQUITY_RECORD.size
+        if torn:  # half-written record from a crash
+            self.f.truncate(size - torn)
+        self.n = (size - torn) // EQUITY_RECORD.size
+        self.last_bucket = self[self.n - 1][0] if self.n else None
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> tuple:
+        self.f.seek(i * EQUITY_RECORD.size)
+        return EQUITY_RECORD.unpack(self.f.read(EQUITY_RECORD.size))
+
+    def record(self, ts: float, equity: float, wallet: float, pnl_open: float):
+        bucket = int(ts) - int(ts) % self.width
+        if self.last_bucket is not None and bucket < self.last_bucket:
+            return  # clock stepped back; keep the file sorted
+        i = self.n - 1 if bucket == self.last_bucket else self.n
+        self.f.seek(i * EQUITY_RECORD.size)
+        self.f.write(EQUITY_RECORD.pack(bucket, equity, wallet, pnl_open))
+        self.f.flush()
+        self.n = i + 1
+        self.last_bucket = bucket
+
+    def range(self, start: float, end: float) -> list[tuple]:
+        """Records with start <= bucket < end."""
+        lo = bisect.bisect_left(self, start, key=lambda r: r[0])
+        hi = bisect.bisect_left(self, end, lo=lo, key=lambda r: r[0])
+        if hi <= lo:
+            return []
+        self.f.seek(lo * EQUITY_RECORD.size)
+        return list(EQUITY_RECORD.iter_unpack(self.f.read((hi - lo) * EQUITY_RECORD.size)))
+
+
+class DailyEquityIndex:
+    """
+    One user's daily closing equity as a dense array indexed by day (days
+    without a sample carry the previous close). The close is the running sum
+    of every day's PnL, so any range's change and return come from the two
+    closes bounding it: two array reads, whatever the range length. Days are
+    UTC days since the epoch.
+    """
+
+    def __init__(self):
+        self.first_day = None
+        self.equity: list[float] = []
+
+    @property
+    def last_day(self):
+        return self.first_day + len(self.equity) - 1 if self.equity else None
+
+    def update(self, day: int, equity: float):
+        if not self.equity:
+            self.first_day = day
+            self.equity.append(equity)
+            return
+        last = self.last_day
+        if day < last:
+            return
+        if day == last:
+            self.equity[-1] = equity
+            return
+        self.equity.extend([self.equity[-1]] * (day - last - 1))  # gap: carry the last close
+        self.equity.append(equity)
+
+    def range_return(self, first_day: int, last_day: int) -> dict | None:
+        """
+        Return from the close before first_day to the close of last_day,
+        clipped to the days on record; None if none of the range is covered.
+        pct is None when the starting equity isn't positive.
+        """
+        if not self.equity:
+            return None
+        start = max(first_day - 1, self.first_day)
+        end = min(last_day, self.last_day)
+        if end < start or end < first_day:
+            return None
+        e0, e1 = self.equity[start - self.first_day], self.equity[end - self.first_day]
+        return {
+            "start_day": start,
+            "end_day": end,
+            "clipped": start > first_day - 1,
+            "start_equity": e0,
+            "end_equity": e1,
+            "pnl": e1 - e0,
+            "pct": (e1 / e0 - 1) * 100 if e0 > 0 else None,
+        }
+
+
+class EquityStore:
+    def __init__(self, directory: Path):
+        self.dir = directory
+        self.lock = threading.Lock()
+        self.series: dict[tuple[int, str], EquitySeries] = {}
+        self.daily: dict[int, DailyEquityIndex] = {}
+
+    def _series(self, user_id: int, tier: str) -> EquitySeries:
+        s = self.series.get((user_id, tier))
+        if s is None:
+            self.dir.mkdir(exist_ok=True)
+            s = self.series[(user_id, tier)] = EquitySeries(self.dir / f"{user_id}.{tier}.bin", EQUITY_TIERS[tier])
+        return s
+
+    def record(self, user_id: int, ts: float, m: dict):
+        values = (float(m["equity_mtm"]), float(m["wallet_balance"]), float(m["pnl_open"]))
+        with self.lock:
+            for tier in EQUITY_TIERS:
+                self._series(user_id, tier).record(ts, *values)
+            if user_id in self.daily:
+                self.daily[user_id].update(int(ts) // 86400, values[0])
+
+    def range(self, user_id: int, tier: str, start: float, end: float) -> list[tuple]:
+        with self.lock:
+            return self._series(user_id, tier).range(start, end)
+
+    def range_return(self, user_id: int, first_day: int, last_day: int) -> dict | None:
+        with self.lock:
+            index = self.daily.get(user_id)
+            if index is None:  # built once from the 1d tier, then kept current by record()
+                index = self.daily[user_id] = DailyEquityIndex()
+                for bucket, equity, _, _ in self._series(user_id, "1d").range(0, 2 ** 32):
+                    index.update(bucket // 86400, equity)
+            return index.range_return(first_day, last_day)
+
+equity_store = EquityStore(EQUITY_DIR)
+
+def sample_equity():
+    """Scheduler job: one equity sample per configured user."""
+    for user_id in list(USERS):
+        m, err = MetricsContext(user_id).metrics()
+        if err or not m:
+            stats_inc("equity.sample_failures")
+            continue
+        if not m.get("positions_complete", True):
+            # A missing leg would store a wrong equity_mtm, and the 1d tier
+            # keeps the last sample of the day as its close
+            stats_inc("equity.sample_incomplete")
+            continue
+        try:
+            equity_store.record(user_id, time.time(), m)
+            stats_inc("equity.samples")
+        except Exception as e:
+            logger.warning(f"equity sample failed user={user_id}: {e}")
+            stats_inc("equity.sample_failures")
+
+
+# -------------------- PNL RANGES --------------------
+# /pnl 7d, /pnl ytd, /pnl 2026-03: answered from the daily equity index only
+# (no Bybit calls). Days are UTC, matching the equity tiers.
+def utc_day(d: date) -> int:
+    return (d - date(1970, 1, 1)).days
+
+def day_date(day: int) -> date:
+    return date(1970, 1, 1) + timedelta(days=day)
+
+def parse_pnl_range(arg: str, today: date) -> tuple[int, int, str] | None:
+    """(first_day, last_day, label) for a /pnl argument, or None if unrecognised."""
+    if arg.endswith("d") and arg[:-1].isdigit() and int(arg[:-1]) > 0:
+        n = int(arg[:-1])
+        return utc_day(today) - n + 1, utc_day(today), f"Last {n}d"
+    if arg == "ytd":
+        return utc_day(date(today.year, 1, 1)), utc_day(today), f"YTD {today.year}"
+    try:
+        first = datetime.strptime(arg, "%Y-%m").date()
+        nxt = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+    except (ValueError, OverflowError):  # not YYYY-MM, or 9999-12 has no next month
+        return None
+    return utc_day(first), min(utc_day(nxt) - 1, utc_day(today)), month_label(arg)
+
+def realized_block(user_id: int, first_day: int, last_day: int, top: int = 5) -> str:
+    """Per-symbol realized PnL for the range from the closed-PnL ledger."""
+    try:
+        rows = closed_pnl_ledger.realized_by_symbol(str(user_id), first_day * 86400000, (last_day + 1) * 86400000)
+    except Exception as e:
+        logger.warning(f"ledger read failed user={user_id}: {e}")
+        return ""
+    if not rows:
+        return ""
+    lines = [f"• <b>{sym}</b>: {fmt_usd(pnl)} ({n} closed)" for sym, pnl, n in rows[:top]]
+    total = sum(pnl for _, pnl, _ in rows)
+    return f"\n\n<b>Realized</b> {fmt_usd(total)}\n" + "\n".join(lines)
+
+def render_pnl_range(user_id: int, label: str, r: dict, realized: str = "") -> str:
+    emoji = "📈" if r["pnl"] >= 0 else "📉"
+    pct = f"{r['pct']:+.2f}%" if r["pct"] is not None else "n/a"
+    note = f"\n<i>History starts {day_date(r['start_day'])}</i>" if r["clipped"] else ""
+    return (
+        f"📊 <b>PnL — {label}</b>\n"
+        f"<i>{day_date(r['start_day'])} → {day_date(r['end_day'])} (UTC closes)</i>\n\n"
+        f"👤 <b>{user_id}</b>\n"
+        f"Start (equity): {fmt_usd(r['start_equity'])}\n"
+        f"End (equity): <b>{fmt_usd(r['end_equity'])}</b>\n"
+        f"Change: {fmt_usd(r['pnl'])}\n"
+        f"Result: {emoji} <b>{pct}</b>"
+        f"{note}"
+        f"{realized}"
+    )
+
+def fn_pnl_range(user_id: int, arg: str) -> str:
+    if not get_client_for_user(user_id):
+        return "❌ No API configured for you."
+    rng = parse_pnl_range(arg, datetime.now(timezone.utc).date())
+    if not rng:
+        return "❌ Unknown range. Try <b>/pnl 7d</b>, <b>/pnl ytd</b> or <b>/pnl 2026-03</b>."
+    first_day, last_day, label = rng
+    r = equity_store.range_return(user_id, first_day, last_day)
+    realized = realized_block(user_id, first_day, last_day)
+    if not r:
+        return f"📊 <b>PnL — {label}</b>\n\nNo equity history for that range yet.{realized}"
+    return render_pnl_range(user_id, label, r, realized)
+
+
+# -------------------- CLOSED PNL LEDGER --------------------
+# Realized PnL per user from /v5/position/closed-pnl, kept in SQLite next to
+# the bot state. Each sync reads only what's new since the stored per-category
+# high-water mark (re-reading a short overlap), split into the 7-day windows
+# the endpoint allows and fetched in parallel; rows are keyed by orderId so
+# re-reads insert nothing. The mark only advances past windows that loaded,
+# so a failed window is retried on the next sync.
+LEDGER_CATEGORIES = ("linear", "inverse")
+CLOSED_PNL_PAGE_LIMIT = 100  # endpoint max
+LEDGER_WINDOW_MS = 7 * 86400 * 1000
+LEDGER_OVERLAP_MS = 10 * 60 * 1000
+
+ledger_pool = ThreadPoolExecutor(max_workers=LEDGER_WORKERS, thread_name_prefix="ledger")
+
+def ledger_windows(start_ms: int, end_ms: int) -> list[tuple[int, int]]:
+    out = []
+    while start_ms < end_ms:
+        out.append((start_ms, min(start_ms + LEDGER_WINDOW_MS, end_ms)))
+        start_ms = out[-1][1]
+    return out
+
+def month_bounds_ms(month_key: str) -> tuple[int, int]:
+    first = datetime.strptime(month_key, "%Y-%m").date()
+    nxt = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+    return utc_day(first) * 86400000, utc_day(nxt) * 86400000
+
+
+class ClosedPnlLedger:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS closed_pnl (
+            user_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            side TEXT,
+            qty REAL,
+            closed_pnl REAL NOT NULL,
+            created_ms INTEGER NOT NULL,
+            PRIMARY KEY (user_id, category, order_id)
+        );
+        CREATE INDEX IF NOT EXISTS closed_pnl_user_time ON closed_pnl (user_id, created_ms);
+        CREATE TABLE IF NOT EXISTS closed_pnl_sync (
+            user_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            synced_until_ms INTEGER NOT NULL,
+            PRIMARY KEY (user_id, category)
+        );
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def conn(self) -> sqlite3.Connection:
+        c = self.store.conn()
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    c.executescript(self.SCHEMA)
+                    self.ready = True
+        return c
+
+    def synced_until(self, user_key: str, category: str) -> int | None:
+        row = self.conn().execute(
+            "SELECT synced_until_ms FROM closed_pnl_sync WHERE user_id = ? AND category = ?", (user_key, category)
+        ).fetchone()
+        return row[0] if row else None
+
+    def has_synced(self, user_key: str) -> bool:
+        return self.conn().execute("SELECT 1 FROM closed_pnl_sync WHERE user_id = ?", (user_key,)).fetchone() is not None
+
+    def ingest(self, user_key: str, category: str, rows: list[dict]) -> int:
+        """Insert rows not seen yet; returns how many were new."""
+        records = []
+        for r in rows:
+            try:
+                records.append((
+                    user_key, category, str(r["orderId"]), r.get("symbol") or "", r.get("side"),
+                    float(r.get("closedSize") or r.get("qty") or 0), float(r.get("closedPnl") or 0),
+                    int(r.get("createdTime") or r.get("updatedTime") or 0),
+                ))
+            except (KeyError, TypeError, ValueError):
+                stats_inc("ledger.bad_rows")
+        if not records:
+            return 0
+        c = self.conn()
+        before = c.total_changes
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany("INSERT OR IGNORE INTO closed_pnl VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return c.total_changes - before
+
+    def mark_synced(self, user_key: str, category: str, until_ms: int):
+        self.conn().execute(
+            "INSERT INTO closed_pnl_sync (user_id, category, synced_until_ms) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id, category) DO UPDATE SET synced_until_ms = excluded.synced_until_ms",
+            (user_key, category, until_ms),
+        )
+
+    def realized_by_symbol(self, user_key: str, start_ms: int, end_ms: int) -> list[tuple[str, float, int]]:
+        """(symbol, realized pnl, closed trades) for start_ms <= createdTime < end_ms, biggest first."""
+        return self.conn().execute(
+            "SELECT symbol, SUM(closed_pnl), COUNT(*) FROM closed_pnl "
+            "WHERE user_id = ? AND created_ms >= ? AND created_ms < ? "
+            "GROUP BY symbol ORDER BY ABS(SUM(closed_pnl)) DESC",
+            (user_key, start_ms, end_ms),
+        ).fetchall()
+
+    def realized_total(self, user_key: str, start_ms: int, end_ms: int) -> float | None:
+        """Realized PnL in the range, or None if this user was never synced."""
+        if not self.has_synced(user_key):
+            return None
+        row = self.conn().execute(
+            "SELECT COALESCE(SUM(closed_pnl), 0) FROM closed_pnl WHERE user_id = ? AND created_ms >= ? AND created_ms < ?",
+            (user_key, start_ms, end_ms),
+        ).fetchone()
+        return float(row[0])
+
+    def sync_user(self, user_id: int, client: BybitClient) -> int:
+        """Pull new closed-PnL rows for one user; returns how many were new."""
+        user_key = str(user_id)
+        now_ms = int(time.time() * 1000)
+        jobs = []
+        for category in LEDGER_CATEGORIES:
+            since = self.synced_until(user_key, category)
+            start = now_ms - LEDGER_BACKFILL_DAYS * 86400000 if since is None else max(0, since - LEDGER_OVERLAP_MS)
+            for ws, we in ledger_windows(start, now_ms):
+                params = {"category": category, "startTime": str(ws), "endTime": str(we)}
+                fut = ledger_pool.submit(
+                    lambda p=params: list(client.iter_list("/v5/position/closed-pnl", p, CLOSED_PNL_PAGE_LIMIT))
+                )
+                jobs.append((category, we, fut))
+
+        new = 0
+        synced: dict[str, int] = {}
+        failed: set[str] = set()
+        for category, window_end, fut in jobs:  # windows are in time order per category
+            try:
+                rows = fut.result()
+            except Exception as e:
+                if category not in failed:
+                    logger.warning(f"closed-pnl sync user={user_id} {category} failed: {e}")
+                failed.add(category)
+                stats_inc("ledger.window_failures")
+                continue
+            new += self.ingest(user_key, category, rows)
+            if category not in failed:
+                synced[category] = window_end
+        for category, until_ms in synced.items():
+            self.mark_synced(user_key, category, until_ms)
+        stats_inc("ledger.rows_new", new)
+        return new
+
+closed_pnl_ledger = ClosedPnlLedger(state_store)
+
+def sync_closed_pnl():
+    """Scheduler job: incremental closed-PnL sync for every configured user."""
+    for user_id, client in list(USERS.items()):
+        try:
+            new = closed_pnl_ledger.sync_user(user_id, client)
+            if new:
+                logger.info(f"closed-pnl ledger user={user_id}: {new} new rows")
+        except Exception as e:
+            logger.warning(f"closed-pnl sync user={user_id} failed: {e}")
+
 
 # -------------------- BOT TEXT --------------------
 def fn_commands() -> str:
     return (
         "✨ <b>Quick Commands</b>\n\n"
-        "• <b>/wallet</b> — balances & positions menu\n"
+        "• <b>/wallet</b> — balances & positions menu (<b>/wallet refresh</b> reloads from Bybit)\n"
         "• <b>/pnl</b> — month-to-date PnL (includes open trades)\n"
+        "• <b>/pnl 7d</b> · <b>/pnl ytd</b> · <b>/pnl 2026-03</b> — PnL over a range\n"
         "• <b>/ids</b> — show your user_id & chat_id\n"
         "• <b>/commands</b> — show this list"
     )
@@ -493,15 +2721,7 @@ def fn_ids(message: dict) -> str:
 
 
 # -------------------- WALLET MENU FUNCTIONS --------------------
-def fn_free_balance(user_id: int) -> str:
-    client = get_client_for_user(user_id)
-    if not client:
-        return "⛔️ No API configured for you."
-
-    m, err = compute_trade_metrics(client)
-    if err:
-        return f"❌ {err}"
-
+def render_free_balance(m: dict) -> str:
     free_to_use = max(0.0, float(m["available_margin"]))
     buffer_margin = max(0.0, float(m["capital_free_real"]))
 
@@ -513,15 +2733,7 @@ def fn_free_balance(user_id: int) -> str:
         f"ℹ️ Assets (Bybit): {fmt_usd(m['assets_now'])}"
     )
 
-def fn_in_trade_cost(user_id: int) -> str:
-    client = get_client_for_user(user_id)
-    if not client:
-        return "⛔️ No API configured for you."
-
-    m, err = compute_trade_metrics(client)
-    if err:
-        return f"❌ {err}"
-
+def render_in_trade_cost(m: dict) -> str:
     return (
         f"🟠 <b>In-Trade (Cost)</b> <i>{m['acct']}</i>\n"
         f"Cost basis: <b>{fmt_usd(m['capital_cost'])}</b>\n"
@@ -530,15 +2742,7 @@ def fn_in_trade_cost(user_id: int) -> str:
         f"ℹ️ Used: {fmt_usd(m['used'])} | Open PnL: {fmt_usd(m['pnl_open'])}"
     )
 
-def fn_open_positions(user_id: int) -> str:
-    client = get_client_for_user(user_id)
-    if not client:
-        return "⛔️ No API configured for you."
-
-    m, err = compute_trade_metrics(client)
-    if err:
-        return f"❌ {err}"
-
+def render_open_positions(m: dict) -> str:
     positions = [p for p in m["positions"] if float(p.get("size") or 0) > 0]
     if not positions:
         return "📌 <b>Open Positions</b>\n— none —"
@@ -549,35 +2753,38 @@ def fn_open_positions(user_id: int) -> str:
     extra = f"\n<i>+{len(positions)-12} hidden</i>" if len(positions) > 12 else ""
     return "📌 <b>Open Positions</b>\n" + "\n".join(lines) + extra
 
+def _wallet_view(user_id: int, render) -> str:
+    ctx = MetricsContext(user_id)
+    if not ctx.client:
+        return "⛔️ No API configured for you."
+
+    m, err = ctx.metrics()
+    if err:
+        return f"❌ {err}"
+    return render(m)
+
 
 # -------------------- BTC ALERTS --------------------
-def get_btc_price():
-    url = f"{BYBIT_BASE_URL}/v5/market/tickers"
-    params = {"category": "linear"}
-    r = requests.get(url, params=params, timeout=10)
-    data = r.json()
-    if data.get("retCode") != 0:
+def btc_from_row(t: dict | None):
+    if not t:
         return None
-    for t in (data.get("result") or {}).get("list") or []:
-        if t.get("symbol") == "BTCUSDT":
-            return float(t["lastPrice"]), float(t.get("price24hPcnt", 0)) * 100
-    return None
+    return float(t["lastPrice"]), float(t.get("price24hPcnt", 0)) * 100
 
-def send_btc_update(force: bool = False):
-    global btc_last_sent_ts
-    if not TELEGRAM_CHAT_ID:
-        return
+def get_btc_price(max_age: float = TICKER_MAX_AGE_SECONDS):
+    row = price_feed.get("BTCUSDT", "linear")
+    if not row or not row.get("lastPrice"):
+        row, _, _ = ticker_cache.get("BTCUSDT", "linear", max_age=max_age)
+    return btc_from_row(row)
 
-    now_ts = int(time.time())
+def btc_due(force: bool) -> bool:
+    if not TELEGRAM_CHAT_ID:
+        return False
     if not force:
-        if btc_last_sent_ts and (now_ts - btc_last_sent_ts) < BTC_ALERT_SECONDS:
-            return
-
-    got = get_btc_price()
-    if not got:
-        return
+        if btc_last_sent_ts and (int(time.time()) - btc_last_sent_ts) < BTC_ALERT_SECONDS:
+            return False
+    return True
 
-    price, change = got
+def btc_alert_text(price: float, change: float) -> str:
     emoji = "📊"
     if change > 5:
         emoji = "🚀"
@@ -587,139 +2794,831 @@ def send_btc_update(force: bool = False):
         emoji = "📉"
     elif change < 0:
         emoji = "🔻"
+    return f"{emoji} <b>BTC</b> {fmt_usd(price)} ({change:+.2f}%)"
 
-    ok, err, _ = telegram_send(str(TELEGRAM_CHAT_ID), f"{emoji} <b>BTC</b> {fmt_usd(price)} ({change:+.2f}%)")
+def btc_mark_sent(ts: int):
+    global btc_last_sent_ts
+    btc_last_sent_ts = ts
+    save_btc_last_sent(ts)
+
+def send_btc_update(force: bool = False):
+    if not btc_due(force):
+        return
+
+    now_ts = int(time.time())
+    got = get_btc_price()
+    if not got:
+        return
+
+    price, change = got
+    ok, err, _ = telegram_send(str(TELEGRAM_CHAT_ID), btc_alert_text(price, change), priority=PRIORITY_ALERT)
     if ok:
-        btc_last_sent_ts = now_ts
-        save_btc_last_sent(now_ts)
+        btc_mark_sent(now_ts)
     else:
         logger.error(f"BTC update failed: {err}")
 
 
-# -------------------- MAIN LOOP --------------------
-def main():
-    require_env()
+# -------------------- UPDATE HANDLING --------------------
+def match_command(text_l: str) -> str | None:
+    if text_l.startswith("/commands") or text_l.startswith("/comandos"):
+        return "commands"
+    if text_l.startswith("/ids") or text_l.startswith("/id"):
+        return "ids"
+    if text_l.startswith("/pnl") or text_l.startswith("/mensal"):
+        return "pnl"
+    if text_l.startswith("/wallet") or text_l.startswith("/saldo"):
+        return "wallet"
+    return None
 
-    global USERS
-    USERS = load_users()
+COMMAND_DELETE_SECONDS = {
+    "commands": COMMANDS_DELETE_SECONDS,
+    "ids": IDS_DELETE_SECONDS,  # ✅ auto-delete 5s
+    "pnl": PNL_DELETE_SECONDS,  # ✅ auto-delete 7s
+}
+
+WALLET_RENDERERS = {
+    "pos:open": render_open_positions,
+    "cap:free": render_free_balance,
+    "cap:trade": render_in_trade_cost,
+}
+
+def command_arg(text_l: str) -> str | None:
+    """First word after the command, e.g. "7d" for "/pnl 7d"."""
+    parts = text_l.split()
+    return parts[1] if len(parts) > 1 else None
+
+def update_user_id(upd: dict) -> int:
+    """Dispatch key for an update; raises ValueError/TypeError/AttributeError on malformed ones."""
+    if not isinstance(upd, dict):
+        raise ValueError("update is not a JSON object")
+    if "message" in upd:
+        return int(((upd["message"] or {}).get("from") or {}).get("id", 0))
+    if "callback_query" in upd:
+        return int(((upd["callback_query"] or {}).get("from") or {}).get("id", 0))
+    return 0
+
+NO_API_TEXT = "⛔️ No API configured for you."
+WALLET_MENU_TEXT = "💼 <b>Wallet</b>\nPick an option:"
+
+def route_update(upd: dict) -> dict | None:
+    """
+    Engine-independent half of update handling: parse the update, apply the
+    chat limit and decide what to do. Both engines execute the returned action
+    with their own I/O; None means ignore the update.
+    """
+    # ---------------- MESSAGE ----------------
+    if "message" in upd:
+        msg = upd["message"] or {}
+        chat_id = str((msg.get("chat") or {}).get("id", ""))
+        text_l = (msg.get("text") or "").strip().lower()
+        user_id = int((msg.get("from") or {}).get("id", 0))
+
+        # Chat limit (if set)
+        if TELEGRAM_CHAT_ID and chat_id != str(TELEGRAM_CHAT_ID):
+            return None
+
+        cmd = match_command(text_l)
+        if cmd is None:
+            return None
+        if cmd == "wallet" and not get_client_for_user(user_id):
+            cmd = "no_api"
+        return {
+            "action": cmd,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "user_msg_id": int(msg.get("message_id", 0)),
+            "arg": command_arg(text_l),
+            "msg": msg,
+        }
 
-    logger.info("🤖 Bot started. Testnet=%s | Users=%s | CHAT_LIMIT=%s | BTC_ALERT_SECONDS=%s",
-                BYBIT_TESTNET, list(USERS.keys()), TELEGRAM_CHAT_ID or "(no limit)", BTC_ALERT_SECONDS)
+    # ---------------- CALLBACK ----------------
+    if "callback_query" in upd:
+        cq = upd["callback_query"] or {}
+        msg = cq.get("message") or {}
+        chat_id = str((msg.get("chat") or {}).get("id", ""))
+        user_id = int((cq.get("from") or {}).get("id", 0))
+
+        # Chat limit (if set)
+        if TELEGRAM_CHAT_ID and chat_id != str(TELEGRAM_CHAT_ID):
+            action = "invalid_chat"
+        elif not get_client_for_user(user_id):
+            action = "no_api"
+        else:
+            action = "wallet_view"
+        return {
+            "action": action,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "cq_id": cq.get("id"),
+            "render": WALLET_RENDERERS.get(cq.get("data") or ""),
+        }
 
-    telegram_delete_webhook_drop_pending()
-    load_btc_last_sent()
+    return None
 
-    # Send 1 BTC alert on startup (if TELEGRAM_CHAT_ID is set)
+def command_reply(r: dict) -> str:
+    """Reply text for the commands that need no Bybit I/O."""
+    if r["action"] == "commands":
+        return fn_commands()
+    return fn_ids(r["msg"])
+
+def wallet_warmup_needed(r: dict) -> bool:
+    """
+    /wallet warms the snapshot so the first button tap answers from memory,
+    unless the private stream is live (no REST calls) or the snapshot is
+    still fresh. /wallet refresh drops the snapshot first to force a reload.
+    """
+    if r["arg"] == "refresh":
+        snapshot_cache.invalidate(r["user_id"])
+    if live_account_metrics(r["user_id"]):
+        return False
+    return snapshot_cache.lookup(r["user_id"])[1] != "fresh"
+
+def remember_wallet_menu(r: dict, menu_msg_id: int):
+    wallet_context[r["user_id"]] = {
+        "cmd_msg_id": r["user_msg_id"],
+        "menu_msg_id": menu_msg_id,
+        "chat_id": r["chat_id"]
+    }
+
+def wallet_cleanup(user_id: int, reply_msg_id: int) -> tuple[str, list[int]] | None:
+    """Pops the open menu for user_id and returns (chat_id, message ids to delete)."""
+    ctx = wallet_context.pop(user_id, None)
+    if not ctx:
+        return None
+    return ctx["chat_id"], [ctx["cmd_msg_id"], ctx["menu_msg_id"], reply_msg_id]
+
+def handle_update(upd: dict):
+    r = route_update(upd)
+    if r is None:
+        return
+    action, chat_id, user_id = r["action"], r["chat_id"], r["user_id"]
+
+    if r.get("cq_id"):
+        telegram_answer_callback(r["cq_id"])
+
+    if action == "invalid_chat":
+        telegram_answer_callback(r["cq_id"], "Invalid chat.", show_alert=True)
+        return
+
+    if action == "no_api":
+        telegram_send(chat_id, NO_API_TEXT)
+        return
+
+    # /commands, /ids, /pnl => reply + auto-delete
+    if action in COMMAND_DELETE_SECONDS:
+        out = fn_pnl(user_id, r["arg"]) if action == "pnl" else command_reply(r)
+        ok, _, reply_id = telegram_send(chat_id, out)
+        if ok and reply_id:
+            schedule_cleanup(chat_id, [r["user_msg_id"], reply_id], delay_seconds=COMMAND_DELETE_SECONDS[action])
+        return
+
+    # /wallet (and /saldo) => inline menu
+    if action == "wallet":
+        if wallet_warmup_needed(r):
+            client = get_client_for_user(user_id)
+            snapshot_cache.refresh_async(user_id, lambda: compute_trade_metrics(client))
+
+        ok, _, menu_msg_id = telegram_send(chat_id, WALLET_MENU_TEXT, reply_markup=kb_wallet_menu())
+        if ok and menu_msg_id:
+            remember_wallet_menu(r, menu_msg_id)
+        return
+
+    if action == "wallet_view":
+        out = _wallet_view(user_id, r["render"]) if r["render"] else "Unknown option."
+        ok, _, reply_msg_id = telegram_send(chat_id, out)
+        cleanup = wallet_cleanup(user_id, reply_msg_id) if ok and reply_msg_id else None
+        if cleanup:
+            schedule_cleanup(*cleanup, delay_seconds=AUTO_DELETE_SECONDS)
+
+
+# -------------------- DISPATCHER --------------------
+class UpdateDispatcher:
+    """
+    Runs handlers on a bounded worker pool. Updates that share a key (user_id)
+    are queued and run strictly in arrival order; different keys run in parallel,
+    so one slow Bybit account never stalls the rest of the chat.
+    """
+
+    def __init__(self, workers: int):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self.lock = threading.Lock()
+        self.queues: dict[int, deque] = {}  # key -> pending (fn, arg, enqueued_at)
+        self.depth = 0
+
+    def submit(self, key: int, fn, arg):
+        with self.lock:
+            q = self.queues.get(key)
+            idle = q is None
+            if idle:
+                q = self.queues[key] = deque()
+            q.append((fn, arg, time.perf_counter()))
+            self.depth += 1
+            stats_gauge("dispatch.queue_depth", self.depth)
+        if idle:
+            self.pool.submit(self._drain, key)
+
+    def _drain(self, key: int):
+        while True:
+            with self.lock:
+                q = self.queues[key]
+                if not q:
+                    del self.queues[key]
+                    return
+                fn, arg, enqueued_at = q.popleft()
+                self.depth -= 1
+                stats_gauge("dispatch.queue_depth", self.depth)
+
+            started = time.perf_counter()
+            stats_observe("dispatch.wait_s", started - enqueued_at)
+            try:
+                fn(arg)
+            except Exception as e:
+                logger.error(f"Handler error (user={key}): {e}")
+            stats_observe("dispatch.handler_s", time.perf_counter() - started)
+
+dispatcher = UpdateDispatcher(DISPATCH_WORKERS)
+
+
+# -------------------- WEBHOOK SERVER --------------------
+def webhook_secret_ok(header_value: str | None) -> bool:
+    return hmac.compare_digest((header_value or "").encode(), (WEBHOOK_SECRET or "").encode())
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Receives Telegram updates, checks the secret token header, hands the update
+    to the dispatcher and acks straight away (handlers run after the 200).
+    """
+
+    def _reply(self, code: int, body: bytes = b""):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        # Health check for load balancers
+        self._reply(200 if self.path == "/healthz" else 404, b"ok" if self.path == "/healthz" else b"")
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self._reply(404)
+        if not webhook_secret_ok(self.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+            stats_inc("webhook.rejected")
+            return self._reply(403)
+        try:
+            upd = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+            key = update_user_id(upd)
+        except Exception:
+            stats_inc("webhook.malformed")
+            return self._reply(400)
+
+        stats_inc("webhook.updates")
+        dispatcher.submit(key, handle_update, upd)
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        logger.debug("webhook: " + format % args)
+
+def start_webhook_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return server
+
+
+# -------------------- ASYNC ENGINE (BOT_ENGINE=async) --------------------
+# Same handlers, same parsing/rendering helpers, but every Telegram and Bybit
+# call is a coroutine on one aiohttp session, so many in-flight requests share
+# a single thread instead of each blocking a worker.
+class AsyncTransport:
+    def __init__(self, pool_size: int):
+        connector = aiohttp.TCPConnector(limit_per_host=pool_size, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    async def request(self, method: str, url: str, timeout=None, **kwargs):
+        """Returns (json_body, response_headers)."""
+        host = urlsplit(url).hostname or ""
+        if timeout is None:
+            timeout = HOST_TIMEOUTS.get(host, 20)
+        stats_inc(f"ahttp.{host}.requests")
+        async with self.session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as r:
+            if r.status >= 500:
+                raise TransientError(f"HTTP {r.status}")
+            return await r.json(content_type=None), r.headers
+
+    async def request_json(self, method: str, url: str, timeout=None, **kwargs) -> dict:
+        return (await self.request(method, url, timeout=timeout, **kwargs))[0]
+
+    async def close(self):
+        await self.session.close()
+
+atransport: AsyncTransport | None = None
+_async_tasks: set = set()
+
+def _spawn(coro):
+    # Keep a reference so fire-and-forget tasks aren't garbage collected mid-flight
+    task = asyncio.ensure_future(coro)
+    _async_tasks.add(task)
+    task.add_done_callback(_async_tasks.discard)
+    return task
+
+async def aresilient_call(endpoint: str, fn, fallback, idempotent=True):
+    """Async counterpart of resilient_call; fn is a coroutine function."""
+    transient = TRANSIENT_ERRORS + (aiohttp.ClientError, asyncio.TimeoutError)
+    breaker = breaker_for(endpoint)
+    attempts = max(1, RETRY_ATTEMPTS) if idempotent else 1
+    for attempt in range(attempts):
+        if not breaker.allow():
+            stats_inc("resilience.fast_fails")
+            return fallback(f"circuit open: {endpoint}")
+        try:
+            result = await fn()
+        except transient as e:
+            if not _attempt_failed(endpoint, breaker, attempt, attempts, e):
+                return fallback(f"{type(e).__name__}: {e}")
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        except Exception:
+            breaker.failure()
+            raise
+        breaker.success()
+        return result
+
+
+async def atg_get(method: str, params: dict | None = None, timeout=None):
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    return await aresilient_call(
+        f"telegram.{method}",
+        lambda: atransport.request_json("GET", url, params=params, timeout=timeout),
+        telegram_fallback,
+    )
+
+async def atg_post(method: str, payload: dict, timeout=None):
+    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/{method}"
+    return await aresilient_call(
+        f"telegram.{method}",
+        lambda: atransport.request_json("POST", url, json=payload, timeout=timeout),
+        telegram_fallback,
+        idempotent=method in TG_IDEMPOTENT_METHODS,
+    )
+
+async def aoutbox_call(method: str, payload: dict, priority: int = PRIORITY_REPLY) -> dict:
+    # Same rate-limited outbox as the sync engine, drained by a task on this loop
+    return await asyncio.wrap_future(outbox.submit(method, payload, priority))
+
+async def atelegram_send(chat_id: str, text: str, reply_markup: dict | None = None, priority: int = PRIORITY_REPLY):
+    return send_result(await aoutbox_call("sendMessage", send_payload(chat_id, text, reply_markup), priority))
+
+async def atelegram_delete_message(chat_id: str, message_id: int):
+    data = await aoutbox_call("deleteMessage", {"chat_id": chat_id, "message_id": message_id}, PRIORITY_CLEANUP)
+    return delete_result(data, chat_id, message_id)
+
+async def atelegram_delete_messages(chat_id: str, message_ids: list[int]):
+    for batch in delete_batches(message_ids):
+        if len(batch) > 1:
+            data = await aoutbox_call("deleteMessages", {"chat_id": chat_id, "message_ids": batch}, PRIORITY_CLEANUP)
+            if data.get("ok"):
+                stats_inc("cleanup.batched", len(batch))
+                continue
+            logger.warning(f"deleteMessages failed chat={chat_id} ids={batch}: {data}; deleting one by one")
+        for mid in batch:
+            await atelegram_delete_message(chat_id, mid)
+
+async def atelegram_answer_callback(callback_query_id: str, text: str = "", show_alert: bool = False):
+    await atg_post("answerCallbackQuery", {
+        "callback_query_id": callback_query_id,
+        "text": text,
+        "show_alert": show_alert
+    })
+
+async def atelegram_get_updates(timeout=30):
+    data = await atg_get("getUpdates", get_updates_params(timeout), timeout=timeout + TELEGRAM_HTTP_TIMEOUT)
+    updates = accept_updates(data)
+    if updates is None:
+        await asyncio.sleep(5)
+        return []
+    return updates
+
+def aschedule_cleanup(chat_id: str, msg_ids: list[int], delay_seconds: int):
+    # Same persisted queue as the sync engine; its thread calls back into the loop
+    cleanup_queue.add(chat_id, msg_ids, delay_seconds)
+
+
+class AsyncBybitClient:
+    """Coroutine front-end for a BybitClient (reuses its keys and signing)."""
+
+    def __init__(self, client: BybitClient):
+        self.client = client
+
+    async def sign_get(self, path: str, query_params: dict, recv_window="5000"):
+        url = f"{self.client.base_url}{path}"
+
+        async def attempt():
+            await bybit_governor.aacquire(self.client.key_id, path)
+            headers = self.client.auth_headers(query_params, recv_window)
+            data, resp_headers = await atransport.request("GET", url, params=query_params, headers=headers)
+            bybit_governor.update(self.client.key_id, path, resp_headers, data)
+            return bybit_checked(data)
+        return await singleflight.ado(
+            flight_key(path, query_params, self.client.api_key),
+            lambda: aresilient_call(f"bybit{path}", attempt, bybit_fallback),
+        )
+
+    async def iter_list(self, path: str, query_params: dict, limit: int):
+        """Async-generator counterpart of BybitClient.iter_list."""
+        cursor = None
+        seen = set()
+        while True:
+            rows, cursor = list_page(await self.sign_get(path, page_params(query_params, limit, cursor)))
+            for row in rows:
+                yield row
+            if not cursor or cursor in seen:
+                return
+            seen.add(cursor)
+
+    async def wallet_best(self):
+        last = None
+        for acct in self.client.wallet_account_order():
+            data = await self.sign_get("/v5/account/wallet-balance", {"accountType": acct, "coin": WALLET_COINS})
+            res = wallet_result(data, acct)
+            if res:
+                self.client.remember_account_type(acct)
+                return res
+            last = wallet_error(data, acct)
+        return None, last, None
+
+    async def open_positions_all(self):
+        timings = {}
+
+        async def leg(category, settle):
+            t0 = time.perf_counter()
+            try:
+                params = {"category": category, "settleCoin": settle}
+                rows = [row async for row in self.iter_list("/v5/position/list", params, POSITION_PAGE_LIMIT)]
+                return positions_from_rows(rows, category), None
+            except Exception as e:
+                return [], leg_error(e, category, settle)
+            finally:
+                timings[(category, settle)] = time.perf_counter() - t0
+
+        tasks = {asyncio.ensure_future(leg(c, s)): (c, s) for c, s in POSITION_ATTEMPTS}
+        await asyncio.wait(tasks, timeout=POSITIONS_DEADLINE_SECONDS)
+
+        legs = []
+        for task, (category, settle) in tasks.items():
+            if task.done() and not task.cancelled():
+                legs.append(task.result())
+            else:
+                task.cancel()
+                stats_inc("bybit.position_leg_timeouts")
+                logger.warning(f"position leg {category}/{settle} missed the {POSITIONS_DEADLINE_SECONDS}s deadline")
+                legs.append(([], f"timed out ({category}/{settle})"))
+        log_position_legs(timings)
+        return merge_position_legs(legs)
+
+_async_clients: dict[int, AsyncBybitClient] = {}
+
+def get_async_client_for_user(user_id: int) -> AsyncBybitClient | None:
+    client = get_client_for_user(user_id)
+    if not client:
+        return None
+    ac = _async_clients.get(user_id)
+    if ac is None or ac.client is not client:
+        ac = _async_clients[user_id] = AsyncBybitClient(client)
+    return ac
+
+
+async def abybit_fetch_tickers(category: str) -> dict[str, dict]:
+    path = "/v5/market/tickers"
+
+    async def attempt():
+        await bybit_governor.aacquire(None, path)
+        return bybit_checked(await atransport.request_json("GET", f"{BYBIT_BASE_URL}{path}", params={"category": category}, timeout=10))
     try:
-        send_btc_update(force=True)
+        data = await singleflight.ado(
+            flight_key(path, {"category": category}),
+            lambda: aresilient_call(f"bybit{path}", attempt, bybit_fallback),
+        )
+        return index_tickers(category, data)
     except Exception as e:
-        logger.error(f"BTC startup error: {e}")
+        logger.warning(f"tickers {category} failed: {e}")
+        return {}
+
+async def aticker_tables(categories, max_age: float = TICKER_MAX_AGE_SECONDS) -> dict[str, dict]:
+    """Async counterpart of TickerCache.tables_for."""
+    stale = [c for c in categories if ticker_cache.age(c) > max_age]
+    for c, rows in zip(stale, await asyncio.gather(*(abybit_fetch_tickers(c) for c in stale))):
+        ticker_cache.store(c, rows)
+    with ticker_cache.lock:
+        return {c: ticker_cache.tables.get(c, {}) for c in categories}
+
+async def abybit_get_ticker_prices(symbols: list[str], categories: dict | None = None) -> dict[str, tuple]:
+    categories = categories or {}
+    live = price_feed.prices(symbols, categories)
+    rest = [sym for sym in symbols if sym not in live]
+    if not rest:
+        return live
+    tables = await aticker_tables(ticker_categories_needed(rest, categories))
+    for sym in rest:
+        price_feed.want(sym, categories.get(sym))  # category is known now
+    return {**resolve_prices(rest, categories, tables), **live}
+
+async def acompute_trade_metrics(aclient: AsyncBybitClient):
+    (acc, err, acct), (positions, perr) = await asyncio.gather(aclient.wallet_best(), aclient.open_positions_all())
+    if err:
+        return None, err
+    return build_trade_metrics(acc, acct, positions, perr), None
 
-    while True:
-        try:
-            updates = telegram_get_updates(timeout=30)
+async def arefresh_snapshot(user_id: int, aclient: AsyncBybitClient):
+    if not snapshot_cache.claim_refresh(user_id):
+        return
+    try:
+        snapshot_cache.put(user_id, await acompute_trade_metrics(aclient))
+    except Exception as e:
+        logger.warning(f"Snapshot refresh failed (user={user_id}): {e}")
+    finally:
+        snapshot_cache.release_refresh(user_id)
+
+async def acached_trade_metrics(user_id: int, aclient: AsyncBybitClient):
+    """Coroutine counterpart of SnapshotCache.get over acompute_trade_metrics."""
+    live = live_account_metrics(user_id)
+    if live:
+        return live
+    result, state = snapshot_cache.lookup(user_id)
+    stats_inc(f"snapshot.{state}")
+    if state == "fresh":
+        return result
+    if state == "stale":
+        _spawn(arefresh_snapshot(user_id, aclient))
+        return result
+    result = await acompute_trade_metrics(aclient)
+    snapshot_cache.put(user_id, result)
+    return result
+
+async def afn_pnl(user_id: int, arg: str | None = None) -> str:
+    if arg:
+        return fn_pnl_range(user_id, arg)
+    aclient = get_async_client_for_user(user_id)
+    if not aclient:
+        return "❌ No API configured for you."
+
+    m, err = await acached_trade_metrics(user_id, aclient)
+    if err:
+        return f"❌ Bybit: {err}"
 
-            for upd in updates:
-                # ---------------- MESSAGE ----------------
-                if "message" in upd:
-                    msg = upd["message"] or {}
-                    chat = msg.get("chat") or {}
-                    chat_id = str(chat.get("id", ""))
+    r = mtd_pnl_from_metrics(user_id, m)
+    positions = pnl_open_positions(m)
+    prices = await abybit_get_ticker_prices(*pnl_price_request(positions)) if positions else {}
+    return render_pnl(user_id, r, pnl_position_lines(positions, prices))
 
-                    text = (msg.get("text") or "").strip()
-                    text_l = text.lower()
+async def _awallet_view(user_id: int, render) -> str:
+    aclient = get_async_client_for_user(user_id)
+    if not aclient:
+        return "⛔️ No API configured for you."
 
-                    user = msg.get("from") or {}
-                    user_id = int(user.get("id", 0))
-                    user_msg_id = int(msg.get("message_id", 0))
+    m, err = await acached_trade_metrics(user_id, aclient)
+    if err:
+        return f"❌ {err}"
+    return render(m)
 
-                    # Chat limit (if set)
-                    if TELEGRAM_CHAT_ID and chat_id != str(TELEGRAM_CHAT_ID):
-                        continue
 
-                    # /commands (and /comandos)
-                    if text_l.startswith("/commands") or text_l.startswith("/comandos"):
-                        ok, _, reply_id = telegram_send(chat_id, fn_commands())
-                        if ok and reply_id:
-                            schedule_cleanup(chat_id, [user_msg_id, reply_id], delay_seconds=COMMANDS_DELETE_SECONDS)
-                        continue
+async def aget_btc_price():
+    row = price_feed.get("BTCUSDT", "linear")
+    if not row or not row.get("lastPrice"):
+        row = (await aticker_tables(["linear"]))["linear"].get("BTCUSDT")
+    return btc_from_row(row)
 
-                    # /ids (and /id) ✅ auto-delete 5s
-                    if text_l.startswith("/ids") or text_l.startswith("/id"):
-                        ok, _, reply_id = telegram_send(chat_id, fn_ids(msg))
-                        if ok and reply_id:
-                            schedule_cleanup(chat_id, [user_msg_id, reply_id], delay_seconds=IDS_DELETE_SECONDS)
-                        continue
+async def asend_btc_update(force: bool = False):
+    if not btc_due(force):
+        return
 
-                    # /pnl (and /mensal) ✅ auto-delete 7s
-                    if text_l.startswith("/pnl") or text_l.startswith("/mensal"):
-                        ok, _, reply_id = telegram_send(chat_id, fn_pnl(user_id))
-                        if ok and reply_id:
-                            schedule_cleanup(chat_id, [user_msg_id, reply_id], delay_seconds=PNL_DELETE_SECONDS)
-                        continue
+    now_ts = int(time.time())
+    got = await aget_btc_price()
+    if not got:
+        return
 
-                    # /wallet (and /saldo) => inline menu
-                    if text_l.startswith("/wallet") or text_l.startswith("/saldo"):
-                        if not get_client_for_user(user_id):
-                            telegram_send(chat_id, "⛔️ No API configured for you.")
-                            continue
-
-                        ok, _, menu_msg_id = telegram_send(chat_id, "💼 <b>Wallet</b>\nPick an option:", reply_markup=kb_wallet_menu())
-                        if ok and menu_msg_id:
-                            wallet_context[user_id] = {
-                                "cmd_msg_id": user_msg_id,
-                                "menu_msg_id": menu_msg_id,
-                                "chat_id": chat_id
-                            }
-                        continue
+    price, change = got
+    ok, err, _ = await atelegram_send(str(TELEGRAM_CHAT_ID), btc_alert_text(price, change), priority=PRIORITY_ALERT)
+    if ok:
+        btc_mark_sent(now_ts)
+    else:
+        logger.error(f"BTC update failed: {err}")
 
-                # ---------------- CALLBACK ----------------
-                if "callback_query" in upd:
-                    cq = upd["callback_query"] or {}
-                    cq_id = cq.get("id")
-                    data = cq.get("data") or ""
-                    user_id = int((cq.get("from") or {}).get("id", 0))
 
-                    telegram_answer_callback(cq_id)
+async def ahandle_update(upd: dict):
+    r = route_update(upd)
+    if r is None:
+        return
+    action, chat_id, user_id = r["action"], r["chat_id"], r["user_id"]
 
-                    msg = cq.get("message") or {}
-                    chat_id = str((msg.get("chat") or {}).get("id", ""))
+    if r.get("cq_id"):
+        await atelegram_answer_callback(r["cq_id"])
 
-                    # Chat limit (if set)
-                    if TELEGRAM_CHAT_ID and chat_id != str(TELEGRAM_CHAT_ID):
-                        telegram_answer_callback(cq_id, "Invalid chat.", show_alert=True)
-                        continue
+    if action == "invalid_chat":
+        await atelegram_answer_callback(r["cq_id"], "Invalid chat.", show_alert=True)
+        return
 
-                    if not get_client_for_user(user_id):
-                        telegram_send(chat_id, "⛔️ No API configured for you.")
-                        continue
+    if action == "no_api":
+        await atelegram_send(chat_id, NO_API_TEXT)
+        return
 
-                    if data == "pos:open":
-                        out = fn_open_positions(user_id)
-                    elif data == "cap:free":
-                        out = fn_free_balance(user_id)
-                    elif data == "cap:trade":
-                        out = fn_in_trade_cost(user_id)
-                    else:
-                        out = "Unknown option."
+    if action in COMMAND_DELETE_SECONDS:
+        out = await afn_pnl(user_id, r["arg"]) if action == "pnl" else command_reply(r)
+        ok, _, reply_id = await atelegram_send(chat_id, out)
+        if ok and reply_id:
+            aschedule_cleanup(chat_id, [r["user_msg_id"], reply_id], delay_seconds=COMMAND_DELETE_SECONDS[action])
+        return
 
-                    ok, _, reply_msg_id = telegram_send(chat_id, out)
-                    ctx = wallet_context.get(user_id)
-                    if ok and reply_msg_id and ctx:
-                        ids_to_delete = [ctx["cmd_msg_id"], ctx["menu_msg_id"], reply_msg_id]
-                        schedule_cleanup(ctx["chat_id"], ids_to_delete, delay_seconds=AUTO_DELETE_SECONDS)
-                        wallet_context.pop(user_id, None)
+    if action == "wallet":
+        if wallet_warmup_needed(r):
+            _spawn(arefresh_snapshot(user_id, get_async_client_for_user(user_id)))
 
-        except Exception as e:
-            logger.error(f"Loop error: {e}")
+        ok, _, menu_msg_id = await atelegram_send(chat_id, WALLET_MENU_TEXT, reply_markup=kb_wallet_menu())
+        if ok and menu_msg_id:
+            remember_wallet_menu(r, menu_msg_id)
+        return
+
+    if action == "wallet_view":
+        out = await _awallet_view(user_id, r["render"]) if r["render"] else "Unknown option."
+        ok, _, reply_msg_id = await atelegram_send(chat_id, out)
+        cleanup = wallet_cleanup(user_id, reply_msg_id) if ok and reply_msg_id else None
+        if cleanup:
+            aschedule_cleanup(*cleanup, delay_seconds=AUTO_DELETE_SECONDS)
+
+
+async def amain():
+    global atransport
+    atransport = AsyncTransport(HTTP_POOL_SIZE)
+
+    # asyncio.Lock wakes waiters in FIFO order, so one lock per user keeps
+    # that user's updates ordered while other users run concurrently.
+    user_locks: dict[int, asyncio.Lock] = {}
+    in_flight = 0
+
+    async def run(upd: dict):
+        nonlocal in_flight
+        key = update_user_id(upd)
+        lock = user_locks.setdefault(key, asyncio.Lock())
+        enqueued_at = time.perf_counter()
+        in_flight += 1
+        stats_gauge("dispatch.queue_depth", in_flight)
+        try:
+            async with lock:
+                started = time.perf_counter()
+                stats_observe("dispatch.wait_s", started - enqueued_at)
+                try:
+                    await ahandle_update(upd)
+                except Exception as e:
+                    logger.error(f"Handler error (user={key}): {e}")
+                stats_observe("dispatch.handler_s", time.perf_counter() - started)
+        finally:
+            in_flight -= 1
+            stats_gauge("dispatch.queue_depth", in_flight)
+
+    async def webhook(request):
+        if not webhook_secret_ok(request.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+            stats_inc("webhook.rejected")
+            return aiohttp.web.Response(status=403)
+        try:
+            upd = await request.json()
+            update_user_id(upd)  # a body run() can't key is a 400, not a failed task after the 200
+        except Exception:
+            stats_inc("webhook.malformed")
+            return aiohttp.web.Response(status=400)
+        stats_inc("webhook.updates")
+        _spawn(run(upd))
+        return aiohttp.web.Response()
+
+    runner = None
+    try:
+        if WEBHOOK_URL:
+            app = aiohttp.web.Application()
+            app.router.add_post(WEBHOOK_PATH, webhook)
+            app.router.add_get("/healthz", lambda request: aiohttp.web.Response(text="ok"))
+            runner = aiohttp.web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await aiohttp.web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+            logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            logger.info(f"setWebhook: {await atg_post('setWebhook', set_webhook_payload())}")
+        else:
+            # Avoid "webhook vs polling" conflicts
+            logger.info(f"deleteWebhook: {await atg_get('deleteWebhook', {'drop_pending_updates': 'true'})}")
+        load_btc_last_sent()
+
+        # Periodic jobs run on the scheduler thread and hop onto this loop
+        loop = asyncio.get_running_loop()
+        outbox.start_async(loop, atg_post)
+
+        def on_loop(make_coro):
+            return lambda: asyncio.run_coroutine_threadsafe(make_coro(), loop).result()
+
+        scheduler.add("tickers", TICKER_REFRESH_SECONDS,
+                      on_loop(lambda: aticker_tables(rest_ticker_categories(), max_age=0)), first_delay=0)
+        scheduler.add("stats", STATS_LOG_SECONDS, log_stats)
+        scheduler.add("state_flush", STATE_FLUSH_SECONDS, state_store.flush)
+        if RUN_JOBS:
+            scheduler.add("btc_alert", BTC_ALERT_SECONDS, on_loop(lambda: asend_btc_update(force=True)),
+                          jitter=BTC_ALERT_JITTER_SECONDS)
+            if EQUITY_SAMPLE_SECONDS > 0:
+                scheduler.add("equity", EQUITY_SAMPLE_SECONDS, sample_equity)
+            if LEDGER_SYNC_SECONDS > 0:
+                scheduler.add("ledger", LEDGER_SYNC_SECONDS, sync_closed_pnl, first_delay=0)
+        scheduler.start()
+        cleanup_queue.start(lambda chat_id, mids: asyncio.run_coroutine_threadsafe(
+            atelegram_delete_messages(chat_id, mids), loop).result())
+        if BYBIT_WS_ENABLED:
+            price_feed.start({"BTCUSDT": "linear"})
+        if BYBIT_WS_PRIVATE_ENABLED:
+            start_account_streams()
+
+        if RUN_JOBS:
+            try:
+                await asend_btc_update(force=True)
+            except Exception as e:
+                logger.error(f"BTC startup error: {e}")
+
+        while True:
+            if WEBHOOK_URL:
+                await asyncio.sleep(3600)
+                continue
+            try:
+                for upd in await atelegram_get_updates(timeout=30):
+                    _spawn(run(upd))
+            except Exception as e:
+                logger.error(f"Loop error: {e}")
+                await asyncio.sleep(1)
+    finally:
+        if runner:
+            await runner.cleanup()
+        await atransport.close()
+
+
+# -------------------- MAIN LOOP --------------------
+def main():
+    require_env()
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+    global USERS
+    USERS = load_users()
 
-        # BTC periodic alert
+    logger.info("🤖 Bot started. Engine=%s | Testnet=%s | Users=%s | CHAT_LIMIT=%s | BTC_ALERT_SECONDS=%s | RUN_JOBS=%s",
+                BOT_ENGINE, BYBIT_TESTNET, list(USERS.keys()), TELEGRAM_CHAT_ID or "(no limit)", BTC_ALERT_SECONDS,
+                RUN_JOBS)
+
+    if BOT_ENGINE == "async":
+        if aiohttp is None:
+            raise RuntimeError("BOT_ENGINE=async requires aiohttp (pip install aiohttp)")
+        asyncio.run(amain())
+        return
+
+    if WEBHOOK_URL:
+        start_webhook_server()
+        telegram_set_webhook()
+    else:
+        telegram_delete_webhook_drop_pending()
+    load_btc_last_sent()
+
+    # Periodic work runs on the scheduler, independent of update handling
+    scheduler.add("tickers", TICKER_REFRESH_SECONDS, lambda: ticker_cache.refresh_all(rest_ticker_categories()),
+                  first_delay=0)
+    scheduler.add("stats", STATS_LOG_SECONDS, log_stats)
+    scheduler.add("state_flush", STATE_FLUSH_SECONDS, state_store.flush)
+    if RUN_JOBS:
+        scheduler.add("btc_alert", BTC_ALERT_SECONDS, lambda: send_btc_update(force=True),
+                      jitter=BTC_ALERT_JITTER_SECONDS)
+        if EQUITY_SAMPLE_SECONDS > 0:
+            scheduler.add("equity", EQUITY_SAMPLE_SECONDS, sample_equity)
+        if LEDGER_SYNC_SECONDS > 0:
+            scheduler.add("ledger", LEDGER_SYNC_SECONDS, sync_closed_pnl, first_delay=0)
+    scheduler.start()
+    cleanup_queue.start()
+    if BYBIT_WS_ENABLED:
+        price_feed.start({"BTCUSDT": "linear"})
+    if BYBIT_WS_PRIVATE_ENABLED:
+        start_account_streams()
+
+    # Send 1 BTC alert on startup (if TELEGRAM_CHAT_ID is set)
+    if RUN_JOBS:
         try:
-            send_btc_update(force=False)
+            send_btc_update(force=True)
         except Exception as e:
-            logger.error(f"BTC error: {e}")
+            logger.error(f"BTC startup error: {e}")
 
-        time.sleep(1)
+    while True:
+        # In webhook mode updates arrive via WebhookHandler instead
+        if WEBHOOK_URL:
+            time.sleep(3600)
+            continue
+        try:
+            updates = telegram_get_updates(timeout=30)
+
+            for upd in updates:
+                dispatcher.submit(update_user_id(upd), handle_update, upd)
+
+        except Exception as e:
+            logger.error(f"Loop error: {e}")
+            time.sleep(1)
 
 
 if __name__ == "__main__":
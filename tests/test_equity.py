@@ -0,0 +1,78 @@
+from datetime import date
+from urllib.parse import urlsplit
+
+import pytest
+
+import bot
+
+USER_ID = 111
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+def bybit_response(path: str, params: dict) -> dict:
+    if path == "/v5/account/wallet-balance":
+        return {"retCode": 0, "result": {"list": [{
+            "totalWalletBalance": "1000", "totalEquity": "1010", "totalMarginBalance": "1010",
+            "totalAvailableBalance": "900", "totalPositionIM": "100",
+        }]}}
+    if path == "/v5/position/list":
+        leg = (params.get("category"), params.get("settleCoin"))
+        if leg == ("linear", "USDC"):
+            return {"retCode": 10002, "retMsg": "invalid request, please check your server timestamp"}
+        rows = []
+        if leg == ("linear", "USDT"):
+            rows = [{"symbol": "BTCUSDT", "side": "Buy", "size": "0.01", "unrealisedPnl": "10", "positionIdx": 0}]
+        return {"retCode": 0, "result": {"list": rows, "nextPageCursor": ""}}
+    raise AssertionError(f"unexpected Bybit call {path}")
+
+
+@pytest.fixture
+def partial_legs(monkeypatch, tmp_path):
+    def fake_http_request(method, url, timeout=None, **kwargs):
+        return FakeResponse(bybit_response(urlsplit(url).path, kwargs.get("params") or {}))
+
+    monkeypatch.setattr(bot, "http_request", fake_http_request)
+    monkeypatch.setattr(bot, "equity_store", bot.EquityStore(tmp_path / "equity"))
+    monkeypatch.setattr(bot, "snapshot_cache", bot.SnapshotCache(60, 60, 10))
+    monkeypatch.setattr(bot, "USERS", {USER_ID: bot.BybitClient("key", "secret", bot.BYBIT_BASE_URL, "UNIFIED")})
+
+
+def test_partial_positions_are_not_sampled_or_cached(partial_legs):
+    m, err = bot.compute_trade_metrics(bot.USERS[USER_ID])
+    assert err is None
+    assert m["positions_complete"] is False
+
+    bot.sample_equity()
+
+    assert bot.equity_store.range(USER_ID, "1m", 0, 2 ** 32) == []
+    assert bot.snapshot_cache.lookup(USER_ID) == (None, "miss")
+
+
+def test_range_return_through_zero_equity():
+    index = bot.DailyEquityIndex()
+    for day, equity in ((10, 100.0), (11, 0.0), (12, 50.0)):
+        index.update(day, equity)
+
+    r = index.range_return(11, 12)
+    assert r["pnl"] == -50.0
+    assert r["pct"] == -50.0
+
+    r = index.range_return(12, 12)  # starts from the 0 close: no meaningful percentage
+    assert r["pnl"] == 50.0
+    assert r["pct"] is None
+
+
+def test_parse_pnl_range_last_month_of_calendar():
+    today = date(2026, 3, 15)
+    assert bot.parse_pnl_range("9999-12", today) is None
+    assert bot.parse_pnl_range("2025-12", today)[2:] == (bot.month_label("2025-12"),)
@@ -0,0 +1,68 @@
+from collections import Counter
+from urllib.parse import urlsplit
+
+import pytest
+
+import bot
+
+USER_ID = 111
+
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+def bybit_response(path: str, params: dict) -> dict:
+    if path == "/v5/account/wallet-balance":
+        return {"retCode": 0, "result": {"list": [{
+            "totalWalletBalance": "1000", "totalEquity": "1010", "totalMarginBalance": "1010",
+            "totalAvailableBalance": "900", "totalPositionIM": "100",
+        }]}}
+    if path == "/v5/position/list":
+        rows = []
+        if (params.get("category"), params.get("settleCoin")) == ("linear", "USDT"):
+            rows = [{"symbol": "BTCUSDT", "side": "Buy", "size": "0.01", "unrealisedPnl": "10", "positionIdx": 0}]
+        return {"retCode": 0, "result": {"list": rows, "nextPageCursor": ""}}
+    if path == "/v5/market/tickers":
+        return {"retCode": 0, "result": {"category": params.get("category"), "list": [
+            {"symbol": "BTCUSDT", "lastPrice": "60000", "markPrice": "60001"},
+        ]}}
+    raise AssertionError(f"unexpected Bybit call {path}")
+
+
+@pytest.fixture
+def bybit_calls(monkeypatch, tmp_path):
+    calls = Counter()
+
+    def fake_http_request(method, url, timeout=None, **kwargs):
+        path = urlsplit(url).path
+        calls[path] += 1
+        return FakeResponse(bybit_response(path, kwargs.get("params") or {}))
+
+    monkeypatch.setattr(bot, "http_request", fake_http_request)
+    # Keep state away from the real files next to bot.py
+    for name in ("MONTHLY_FILE", "BTC_LAST_FILE"):
+        monkeypatch.setattr(bot, name, tmp_path / "absent")
+    store = bot.StateStore(tmp_path / "state.db")
+    monkeypatch.setattr(bot, "state_store", store)
+    monkeypatch.setattr(bot, "closed_pnl_ledger", bot.ClosedPnlLedger(store))
+    monkeypatch.setattr(bot, "USERS", {USER_ID: bot.BybitClient("key", "secret", bot.BYBIT_BASE_URL, "UNIFIED")})
+    return calls
+
+
+def test_pnl_bybit_calls(bybit_calls):
+    out = bot.fn_pnl(USER_ID)
+
+    assert "BTCUSDT" in out
+    assert bybit_calls == {
+        "/v5/account/wallet-balance": 1,
+        "/v5/position/list": 4,  # one per POSITION_ATTEMPTS leg
+        "/v5/market/tickers": 1,
+    }